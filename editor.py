@@ -12,7 +12,7 @@ import string
 import sys
 from collections import namedtuple
 from subprocess import Popen, PIPE
-from textwrap import wrap
+import textwrap
 
 
 if sys.version_info.major < 3:
@@ -62,6 +62,21 @@ class Editor(object):
                             (e.g. for passwords)
         edit:           True/False. Default is True for editor. Use False
                             to have a scrollable popup window.
+        getch:          optional function(window) used to read keys instead
+                            of window.getch()
+        profiler:       optional object with start() and stop(phase, t0)
+                            used to time redraws and count(name) used to
+                            count terminal updates
+        wrap:           optional function(text, width, drop_whitespace)
+                            used instead of textwrap.wrap, e.g. one that
+                            counts wide characters twice
+        width:          optional function(text) returning number of
+                            terminal cells text takes, len() by default
+        rawgetch:       optional function(window) used instead of
+                            window.getch() where keys are only peeked at
+                            or dismiss the help popup
+        ungetch:        optional function(key) used instead of
+                            curses.ungetch() to push peeked key back
 
     Returns:
         text:   text string
@@ -78,7 +93,8 @@ class Editor(object):
 
     def __init__(self, scr, title="", inittext="", win_location=(0, 0),
                  win_size=(20, 80), box=True, max_paragraphs=0, pw_mode=False,
-                 edit=True):
+                 edit=True, getch=None, profiler=None, wrap=None,
+                 width=None, rawgetch=None, ungetch=None):
         # Fix for python curses resize bug:
         # http://bugs.python.org/issue2675
         os.unsetenv('LINES')
@@ -93,6 +109,12 @@ class Editor(object):
         self.max_paragraphs = max_paragraphs
         self.pw_mode = pw_mode
         self.edit = edit
+        self.getch = getch
+        self.rawgetch = rawgetch
+        self.ungetch = ungetch or curses.ungetch
+        self.profiler = profiler
+        self.wrap = wrap or textwrap.wrap
+        self.width = width or len
         self.win_location_orig_y, self.win_location_orig_x = win_location
         self.win_size_orig_y, self.win_size_orig_x = win_size
         self.win_size_y = self.win_size_orig_y
@@ -220,22 +242,24 @@ class Editor(object):
         """
         # Touchwin seems to save the underlying screen and refreshes it (for
         # example when the help popup is drawn and cleared again)
+        # Windows are only copied to the virtual screen, run() sends them
+        # to the terminal with a single update
         self.scr.touchwin()
-        self.scr.refresh()
-        self.stdscr.clear()
-        self.stdscr.refresh()
+        self.scr.noutrefresh()
+        self.stdscr.erase()
+        self.stdscr.noutrefresh()
         if self.box is True:
-            self.boxscr.clear()
+            self.boxscr.erase()
             self.boxscr.box()
             if self.title:
                 addstr(self.boxscr, 1, 1, self.title, curses.A_BOLD)
                 addstr(self.boxscr, self.title_help, curses.A_STANDOUT)
-            self.boxscr.refresh()
+            self.boxscr.noutrefresh()
         elif self.title:
-            self.boxscr.clear()
+            self.boxscr.erase()
             addstr(self.boxscr, 0, 0, self.title, curses.A_BOLD)
             addstr(self.boxscr, self.title_help, curses.A_STANDOUT)
-            self.boxscr.refresh()
+            self.boxscr.noutrefresh()
 
     def keys_init(self):
         """Define methods for each key.
@@ -336,8 +360,8 @@ class Editor(object):
         """
         # Use win_size_x - 1 so addstr has one more cell at the end to put the
         # cursor
-        return wrap("".join(text), self.win_size_x - 1,
-                    drop_whitespace=False) or [""]
+        return self.wrap("".join(text), self.win_size_x - 1,
+                         drop_whitespace=False) or [""]
 
     def left(self):
         if self.cur_pos_x > 0:
@@ -721,7 +745,7 @@ class Editor(object):
         except _curses.error:
             pass
         else:
-            while not popup.getch():
+            while not self.raw_key(popup):
                 pass
         finally:
             # Turn back on the cursor
@@ -746,20 +770,71 @@ class Editor(object):
         """
         try:
             while True:
-                self.stdscr.move(self.cur_pos_y, self.cur_pos_x)
+                self.stdscr.move(self.cur_pos_y, self.cursor_x())
+                self.stdscr.noutrefresh()
+                # Keys already typed (e.g. pasted text) are processed
+                # before the terminal is updated
+                if not self.pending():
+                    self.update()
                 loop = self.get_key()
                 if loop is False:
                     break
-                self.display()
+                if self.profiler is not None:
+                    t0 = self.profiler.start()
+                    self.display()
+                    self.profiler.stop('draw', t0)
+                else:
+                    self.display()
         except KeyboardInterrupt:
             self.text = self.text_orig
         return "\n".join(["".join(i) for i in self.text])
 
+    def cursor_x(self):
+        """Return screen column of the cursor, wide characters before it
+        take more than one column.
+
+        """
+        if self.width is len:
+            return self.cur_pos_x
+        rows = self.flattened_text
+        if self.buffer_idx_y >= len(rows):
+            return self.cur_pos_x
+        return min(self.width(rows[self.buffer_idx_y][:self.cur_pos_x]),
+                   self.win_size_x - 1)
+
+    def pending(self):
+        """Check whether a key is waiting to be read, without reading it.
+
+        """
+        self.stdscr.nodelay(1)
+        c = self.raw_key(self.stdscr)
+        self.stdscr.nodelay(0)
+        if c == -1:
+            return False
+        self.ungetch(c)
+        return True
+
+    def raw_key(self, win):
+        """Read a key from the window, bypassing the getch function.
+
+        """
+        if self.rawgetch is not None:
+            return self.rawgetch(win)
+        return win.getch()
+
+    def update(self):
+        """Send all changed windows to the terminal at once.
+
+        """
+        curses.doupdate()
+        if self.profiler is not None:
+            self.profiler.count('editor updates')
+
     def display(self):
         """Display the editor window and the current contents.
 
         """
-        self.stdscr.clear()
+        self.stdscr.erase()
         y_idx = display_idx = 0
         done = False
         for para in self.text:
@@ -787,7 +862,10 @@ class Editor(object):
         return False
 
     def get_key(self):
-        c = self.stdscr.getch()
+        if self.getch is not None:
+            c = self.getch(self.stdscr)
+        else:
+            c = self.stdscr.getch()
         if c == curses.KEY_RESIZE:
             self.resize()
             return True
@@ -5,12 +5,40 @@ This module loads YAML configuration, presents UI to user and allows him to
 set and save values to another YAML file.
 """
 
-import sys
 import os
 import curses
 import curses.textpad
+import sys
 import textwrap
 import re
+import time
+import atexit
+import argparse
+import cProfile
+import threading
+import struct
+import ctypes
+import ctypes.util
+import codecs
+import array
+import bisect
+import gc
+import tracemalloc
+import heapq
+import concurrent.futures
+import multiprocessing
+import mmap
+import hashlib
+import json
+import fnmatch
+import pty
+import select
+import fcntl
+import termios
+import functools
+import unicodedata
+import subprocess
+import abc
 from editor import Editor
 
 try:
@@ -21,874 +49,5224 @@ except ImportError:
         "http://pyyaml.org")
     quit(1)
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 
-def init_curses():
+class Profiler(object):
     """
-    This function sets up basic curses environment.
+    Collects per-keystroke latencies and timings of selected operations.
 
-    :return: Screen object.
+    Each keystroke is measured from the moment the key is read until the next
+    key is requested and split into phases (layout, draw, save). Time spent
+    waiting for input is tracked separately. When disabled, every method
+    returns right away, so instrumented code runs at full speed.
     """
-    stdscr = curses.initscr()
 
-    maxy, maxx = stdscr.getmaxyx()
+    # upper bounds of histogram buckets in milliseconds
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.enabled = False
+        self.samples = {}
+        self.counters = {}
+        self.keystroke = None
+        self.key_time = None
+        self.cprofile = None
+        self.started = None
+
+    def enable(self, cprofile=False):
+        """
+        Turns on the instrumentation.
+
+        :param cprofile: Also run cProfile for the whole session.
+        :return: None.
+        """
+        self.enabled = True
+        self.started = time.perf_counter()
+
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def start(self):
+        """
+        Starts measuring a phase or an operation.
+
+        :return: Start time, or None if profiling is off.
+        """
+        if self.enabled:
+            return time.perf_counter()
+        return None
 
-    if maxy < 24 or maxx < 80:
-        print("Sorry, but at least 80x24 is needed.")
-        clean_curses()
-        quit(1)
+    def stop(self, phase, t0):
+        """
+        Adds time elapsed since t0 to a phase of the current keystroke.
+
+        :param phase: Phase name (layout, draw, save).
+        :param t0: Value returned by start().
+        :return: None.
+        """
+        if t0 is None or self.keystroke is None:
+            return
+
+        elapsed = (time.perf_counter() - t0) * 1000.0
+        self.keystroke[phase] = self.keystroke.get(phase, 0.0) + elapsed
+
+    def record(self, name, t0):
+        """
+        Records duration of a single operation (eg., open_yaml).
+
+        :param name: Operation name.
+        :param t0: Value returned by start().
+        :return: None.
+        """
+        if t0 is None:
+            return
+
+        self.add(name, (time.perf_counter() - t0) * 1000.0)
+
+    def milestone(self, name):
+        """
+        Records time since profiling started when startup reaches a point
+        (eg., first frame drawn), only the first time it's reached.
+
+        :param name: Name of the point.
+        :return: None.
+        """
+        if self.started is None or name in self.samples:
+            return
+
+        self.add(name, (time.perf_counter() - self.started) * 1000.0)
+
+    def add(self, name, ms):
+        """
+        Adds one sample in milliseconds.
+
+        :param name: Name of the histogram.
+        :param ms: Sample value.
+        :return: None.
+        """
+        self.samples.setdefault(name, []).append(ms)
+
+    def count(self, name, n=1):
+        """
+        Increments a counter.
+
+        :param name: Counter name.
+        :param n: Increment.
+        :return: None.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def end_keystroke(self):
+        """
+        Closes the keystroke being processed and stores its phases.
+
+        :return: None.
+        """
+        if self.keystroke is None:
+            return
+
+        total = (time.perf_counter() - self.key_time) * 1000.0
+        other = total
+
+        for phase, ms in self.keystroke.items():
+            self.add('key ' + phase, ms)
+            other -= ms
+
+        self.add('key total', total)
+        self.add('key other', max(other, 0.0))
+        self.keystroke = None
+
+    def getch(self, win):
+        """
+        Reads a key from the window and starts a new keystroke.
+
+        :param win: Curses window object.
+        :return: Key code.
+        """
+        if not self.enabled:
+            return raw_key(win)
+
+        self.end_keystroke()
+
+        t0 = time.perf_counter()
+        ckey = raw_key(win)
+        self.key_time = time.perf_counter()
+
+        # getch() timed out, there's no keystroke to measure
+        if ckey == -1:
+            return ckey
+
+        self.add('input wait', (self.key_time - t0) * 1000.0)
+        self.keystroke = {}
+
+        return ckey
+
+    def histogram(self, values):
+        """
+        Formats values as text histogram.
+
+        :param values: List of samples in milliseconds.
+        :return: List of lines.
+        """
+        counts = [0] * (len(self.buckets) + 1)
+
+        for val in values:
+            for i, bound in enumerate(self.buckets):
+                if val <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
 
-    curses.start_color()
-    curses.use_default_colors()
+        lines = []
+        peak = max(counts)
 
-    curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
-    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
-    curses.init_pair(3, curses.COLOR_BLUE, curses.COLOR_BLACK)
-    curses.init_pair(4, curses.COLOR_RED, curses.COLOR_BLACK)
-    curses.init_pair(5, curses.COLOR_YELLOW, curses.COLOR_BLACK)
-    curses.init_pair(6, curses.COLOR_RED, curses.COLOR_WHITE)
-    curses.init_pair(7, curses.COLOR_MAGENTA, curses.COLOR_BLACK)
+        for i, cnt in enumerate(counts):
+            if cnt == 0:
+                continue
+            if i < len(self.buckets):
+                label = '<= %g ms' % self.buckets[i]
+            else:
+                label = '>  %g ms' % self.buckets[-1]
+            bar = '#' * max(1, int(40 * cnt / peak))
+            lines.append('  %-14s %7d %s' % (label, cnt, bar))
 
-    curses.noecho()
-    curses.cbreak()
-    curses.curs_set(0)
-    curses.mousemask(1)
+        return lines
 
-    stdscr.clear()
-    stdscr.border()
-    stdscr.refresh()
-    stdscr.keypad(1)
+    def report(self):
+        """
+        Prepares text report with statistics and histograms.
 
-    return stdscr
+        :return: Report as string.
+        """
+        self.end_keystroke()
 
+        lines = []
 
-def clean_curses():
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            cnt = len(values)
+            lines.append('%s: n=%d mean=%.3f p50=%.3f p95=%.3f max=%.3f ms' % (
+                name, cnt, sum(values) / cnt, values[int(cnt * 0.5)],
+                values[min(cnt - 1, int(cnt * 0.95))], values[-1]))
+            lines.extend(self.histogram(values))
+            lines.append('')
+
+        for name in sorted(self.counters):
+            lines.append('%s: %d' % (name, self.counters[name]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fn, dump=None):
+        """
+        Writes report to file and optionally dumps cProfile statistics.
+
+        :param fn: Report filename.
+        :param dump: cProfile dump filename or None.
+        :return: None.
+        """
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            if dump is not None:
+                self.cprofile.dump_stats(dump)
+
+        with open(fn, 'w') as stream:
+            stream.write(self.report())
+
+
+class Recorder(object):
+    """
+    Writes every key read by the UI into a file (--record), one JSON list
+    per line with time since start in seconds, key code and terminal size.
+    First line describes the terminal. Timeouts and empty reads of queued
+    keys are recorded too, so replay reads exactly the same keys.
     """
-    Cleans up curses after quit.
 
-    :return: None.
+    def __init__(self, fn):
+        self.stream = open(fn, 'w')
+        self.start = time.perf_counter()
+        rows, cols = self.size()
+        self.stream.write(json.dumps({'version': 1, 'rows': rows,
+                                      'cols': cols,
+                                      'term': os.environ.get('TERM')}) +
+                          '\n')
+
+    def size(self):
+        """
+        Returns current terminal size.
+
+        :return: Tuple of rows and columns.
+        """
+        size = os.get_terminal_size(sys.__stdout__.fileno())
+        return size.lines, size.columns
+
+    def getch(self, win):
+        """
+        Reads and records a key.
+
+        :param win: Curses window object.
+        :return: Key code.
+        """
+        ckey = win.getch()
+        rows, cols = self.size()
+        self.stream.write(json.dumps([
+            round(time.perf_counter() - self.start, 4), ckey, rows, cols]) +
+            '\n')
+        self.stream.flush()
+
+        return ckey
+
+    def unget(self, ckey):
+        """
+        Pushes key back to be read again, the read is recorded again too.
+
+        :param ckey: Key code.
+        :return: None.
+        """
+        curses.ungetch(ckey)
+
+
+class Replayer(object):
     """
-    curses.curs_set(1)
-    curses.nocbreak()
-    curses.endwin()
+    Feeds keys of recorded session back to the UI (--replay) and measures
+    how long each of them takes, from the moment key is returned until the
+    next one is read. Keys are fed as fast as UI reads them. UI runs in a
+    pseudo terminal of recorded size, so no real terminal is needed.
+    """
+
+    def __init__(self, fn):
+        with open(fn) as stream:
+            self.header = json.loads(stream.readline())
+            self.events = [json.loads(line) for line in stream
+                           if line.strip()]
+
+        self.pos = 0
+        self.size = (self.header['rows'], self.header['cols'])
+        self.last = None
+        self.steps = []
+        self.result = None
+
+    def run(self):
+        """
+        Starts UI in a pseudo terminal and waits until replay is finished.
+        Terminal output is only counted.
+
+        :return: False in the process running UI, exit status of UI
+                 process otherwise.
+        """
+        read_fd, write_fd = os.pipe()
+        pid, fd = pty.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            self.result = write_fd
+            os.environ['TERM'] = self.header.get('term') or 'xterm'
+            self.resize(*self.size)
+            atexit.register(self.finish)
+            return False
+
+        os.close(write_fd)
+        report = b''
+        output = 0
+        fds = [fd, read_fd]
+
+        while len(fds) > 0:
+            for ready in select.select(fds, [], [])[0]:
+                try:
+                    data = os.read(ready, 65536)
+                except OSError:
+                    data = b''
+
+                if len(data) == 0:
+                    fds.remove(ready)
+                elif ready == fd:
+                    output += len(data)
+                else:
+                    report += data
+
+        status = os.waitpid(pid, 0)[1]
+        print(report.decode())
+        print("terminal output: %d bytes" % output)
+
+        return os.waitstatus_to_exitcode(status)
+
+    def resize(self, rows, cols):
+        """
+        Changes size of the pseudo terminal.
+
+        :param rows: Number of rows.
+        :param cols: Number of columns.
+        :return: None.
+        """
+        fcntl.ioctl(sys.stdout.fileno(), termios.TIOCSWINSZ,
+                    struct.pack('HHHH', rows, cols, 0, 0))
+        self.size = (rows, cols)
+
+    def getch(self, win):
+        """
+        Returns next recorded key, quits when there are no more.
+
+        :param win: Curses window object.
+        :return: Key code.
+        """
+        now = time.perf_counter()
+
+        # time since the last key belongs to the last real keystroke
+        if self.last is not None and len(self.steps) > 0:
+            self.steps[-1][1] += (now - self.last) * 1000.0
+
+        if self.pos == len(self.events):
+            self.last = None
+            clean_curses()
+            quit(0)
+
+        rows, cols, ckey = (self.events[self.pos][2],
+                            self.events[self.pos][3],
+                            self.events[self.pos][1])
+        self.pos += 1
+
+        if (rows, cols) != self.size:
+            self.resize(rows, cols)
+            curses.resizeterm(rows, cols)
+
+        if ckey != -1:
+            self.steps.append([ckey, 0.0])
+
+        self.last = time.perf_counter()
+
+        return ckey
+
+    def unget(self, ckey):
+        """
+        Key was pushed back, it's the next recorded key too. It's not a
+        keystroke of its own, time belongs to the previous one.
+
+        :param ckey: Key code.
+        :return: None.
+        """
+        if len(self.steps) > 0 and self.steps[-1][0] == ckey:
+            self.steps.pop()
+
+    def report(self):
+        """
+        Describes latencies of replayed keystrokes.
+
+        :return: Report as string.
+        """
+        lines = []
+        values = sorted(ms for ckey, ms in self.steps)
+
+        for i, (ckey, ms) in enumerate(self.steps):
+            name = curses.keyname(ckey).decode('ascii', 'replace')
+            lines.append('%5d %-12s %10.3f ms' % (i + 1, name, ms))
 
+        if len(values) > 0:
+            cnt = len(values)
+            lines.append('')
+            lines.append('replayed %d keys: total=%.3f mean=%.3f p50=%.3f '
+                         'p95=%.3f max=%.3f ms' % (
+                             cnt, sum(values), sum(values) / cnt,
+                             values[int(cnt * 0.5)],
+                             values[min(cnt - 1, int(cnt * 0.95))],
+                             values[-1]))
 
-def draw_menu(screen, yamlobj, menu_titles, mtitle, msel):
+        return '\n'.join(lines)
+
+    def finish(self):
+        """
+        Sends report to the process that started replay.
+
+        :return: None.
+        """
+        os.write(self.result, self.report().encode())
+        os.close(self.result)
+
+
+# recorded or replayed session, None when keys come from the terminal
+SESSION = None
+
+
+def raw_key(win):
     """
-    This function draws a menu with given title and handles the keyboard input.
+    Reads a key from window, or from the session being replayed. Keys are
+    written to the recording when the session is recorded.
 
-    :param screen: Screen object.
-    :param yamlobj: Python object ( nested list / dicts ).
-    :param menu_titles: List of menu titles.
-    :param mtitle: Title of currently active menu.
-    :param msel: Starting position of cursor in menu.
-    :return: Index of selected item.
+    :param win: Curses window object.
+    :return: Key code.
     """
-    maxy, maxx = screen.getmaxyx()
+    if SESSION is None:
+        return win.getch()
 
-    screen.clear()
-    screen.border()
-    screen.refresh()
+    return SESSION.getch(win)
 
-    # calculate minimal menu height
-    if len(menu_titles) < maxy - 4:
-        size_y = len(menu_titles) + 2
+
+def unget_key(ckey):
+    """
+    Pushes key back, so raw_key() returns it next time.
+
+    :param ckey: Key code.
+    :return: None.
+    """
+    if SESSION is None:
+        curses.ungetch(ckey)
     else:
-        size_y = maxy - 4
+        SESSION.unget(ckey)
 
-    # calculate minimal menu width to fit content and title
-    size_x = max(len(max(menu_titles, key=len)), len(mtitle)) + 2
 
-    # some titles are too large
-    if size_x > maxx - 4:
-        size_x = maxx - 4
+# global instrumentation, disabled unless --profile is used
+PROFILER = Profiler()
 
-    # trim title if too long to fit
-    if len(mtitle) > size_x - 2:
-        mtitle = mtitle[0:size_x - 2]
+# timeout of getch() in UI loops in milliseconds, -1 blocks
+INPUT_TIMEOUT = -1
 
-    # calculate position, so the menu is centered
-    pos_y = int(maxy / 2 - size_y / 2)
-    pos_x = int(maxx / 2 - size_x / 2)
+# how long terminal size has to be stable before relayout, in milliseconds
+RESIZE_DELAY = 100
 
-    screen.addstr(0, 2, 'ENTER/SPACE: Enter/edit | ESC/BACKSP: Exit | R: Run '
-                        'commands | Q: Quit ', curses.color_pair(1))
+# keys that are applied together when they queue up
+NAVIGATION_KEYS = (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_PPAGE,
+                   curses.KEY_NPAGE, curses.KEY_HOME, curses.KEY_END)
 
-    # create actual window and border
-    win = curses.newwin(size_y, size_x, pos_y, pos_x)
-    win.attron(curses.A_BOLD)
-    win.border()
-    win.attroff(curses.A_BOLD)
+# page keys that change many checkboxes at once, lowercase ones change the
+# block under cursor, uppercase ones and / (toggle matching) whole page
+BULK_KEYS = {ord('a'): ('all', False), ord('A'): ('all', True),
+             ord('n'): ('none', False), ord('N'): ('none', True),
+             ord('i'): ('invert', False), ord('I'): ('invert', True),
+             ord('/'): ('match', True)}
 
-    # draw title
-    win.addstr(0, int(size_x / 2 - len(mtitle) / 2), mtitle)
+# stream loader leaves longer value scalars in the file until they're shown
+LAZY_TEXT_SIZE = 1024
 
-    # main loop that handles keyboard input and redrawing
-    while True:
+# longer textarea values are saved as separate blob files
+BLOB_SIZE = 4096
 
-        lpos = 0
+# lines of popup text per curses pad
+PAD_LINES = 4096
 
-        # we scrolled somewhere down
-        if msel > size_y - 3:
-            lpos = msel - size_y + 3
+# no borders, colors and non-ASCII markers, set by --low-bandwidth
+LOW_BANDWIDTH = False
 
-        offset = lpos
+# scroll marks of popups, ASCII ones in low bandwidth mode
+SCROLL_MARKS = {False: ('↑↑↑↑↑', '↓↓↓↓↓'), True: ('^^^^^', 'vvvvv')}
 
-        # print the menu content
-        for i in range(1, size_y - 1):
-            mitem = menu_titles[lpos].ljust(size_x - 2)
+# seconds source command outputs are valid unless ttl key says otherwise
+SOURCE_TTL = 60
 
-            if len(mitem) > size_x - 2:
-                mitem = mitem[0:size_x - 5] + "..."
+# seconds after which source command is killed
+SOURCE_TIMEOUT = 30
 
-            if msel + 1 == i + offset:
-                win.addstr(i, 1, str(mitem), curses.color_pair(1))
-            else:
-                win.addstr(i, 1, str(mitem))
+# milliseconds between checks of source commands while a page waits for them
+SOURCE_POLL = 200
 
-            lpos += 1
+# shown instead of values of sourced elements until commands finish
+SOURCE_LOADING = 'loading...'
 
-        win.refresh()
-        ckey = screen.getch()
+# milliseconds between checks whether definition is loaded during startup
+STARTUP_POLL = 100
 
-        # read keys and redraw, return item index on ENTER, return -1 on exit
-        if ckey == curses.KEY_UP:
-            if msel > 0:
-                msel -= 1
-        elif ckey == curses.KEY_DOWN:
-            if msel < len(menu_titles) - 1:
-                msel += 1
-        elif ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
-            del win
-            return msel
-        elif ckey == ord("R") or ckey == ord("r"):
-            run_commands(yamlobj)
-        elif ckey == ord("q") or ckey == ord("Q"):
-            clean_curses()
-            quit(0)
-        elif ckey == 27 or ckey == curses.KEY_BACKSPACE:
-            return -1
 
-    win.refresh()
+def read_key(win):
+    """
+    Reads single key from window. All UI loops should read keys here, so
+    the keystrokes can be instrumented.
 
-    del win
-    screen.touchwin()
-    screen.refresh()
+    :param win: Curses window object.
+    :return: Key code.
+    """
+    ckey = PROFILER.getch(win)
+
+    if ckey == curses.KEY_RESIZE:
+        handle_resize(win)
+
+    return ckey
 
 
-def draw_page(screen, yamlobj, fn, obj, pid, ptitle, msel):
+def handle_resize(win):
     """
-    This functions draws page and its content.
+    Waits until terminal stops changing its size and redraws the background
+    for the final size, so dragging terminal edge results in a single
+    relayout. Callers just lay out their windows again when they get
+    KEY_RESIZE. Background is left alone when keys are read from a
+    subwindow (eg., Editor).
 
-    :param screen: Curses screen object.
-    :param yamlobj: Whole python object ( nested list / dicts ).
-    :param fn: Filename of input file.
-    :param obj: Python object ( nested list / dicts ).
-    :param pid: Page id.
-    :param ptitle: Page title.
-    :param msel: Currently Highlighted item.
-    :return: Position of currently selected page element.
+    :param win: Curses window object.
+    :return: None.
     """
+    t0 = PROFILER.start()
 
-    maxy, maxx = screen.getmaxyx()
+    while True:
 
-    # something to begin with, fit at least page title
-    size_y = 2
-    size_x = len(ptitle) + 2
-    newelem = None
+        # swallow the burst of resize events
+        win.timeout(RESIZE_DELAY)
 
-    # determine page height and width
-    for i, elem in enumerate(obj):
+        while True:
+            ckey = raw_key(win)
 
-        if elem.get('value') is None:
-            value_length = 0
-        else:
-            value_length = len(str(elem.get('value')))
+            if ckey == -1:
+                break
 
-        if 'checkbox' in elem:
-            size_y += 1
-            width = len(elem.get('title')) + 6
-            newelem = 'checkbox'
-        elif 'radio' in elem:
-            size_y += 1
-            width = len(elem.get('title')) + 6
-            newelem = 'radio'
-        elif 'textbox' in elem:
-            size_y += 1
-            width = len(elem.get('title')) + value_length + 4
-            if width > maxx:
-                width = maxx
-            newelem = 'textbox'
-        elif 'textarea' in elem:
-            size_y += 2
-            width = int(maxx / 2)
-            newelem = 'textarea'
-        elif 'textdisplay' in elem:
+            if ckey != curses.KEY_RESIZE:
+                unget_key(ckey)
+                break
 
-            # wrapping is handled here
-            if len(elem.get('value')) > int(maxx / 2):
-                width = int(maxx / 2)
-                wrapped = textwrap.wrap(elem.get('value'), int(maxx / 2) - 2)
+            PROFILER.count('resize events')
 
-                # if it's too long, we will truncate it to five lines
-                if len(wrapped) > 4:
-                    size_y += 5
-                else:
-                    size_y += len(wrapped)
+        win.timeout(INPUT_TIMEOUT)
+        curses.update_lines_cols()
 
-            else:
-                # it's only one line
-                width = len(elem.get('value')) + 2
-                size_y += 1
+        if win.getmaxyx() != (curses.LINES, curses.COLS):
+            return
 
-            newelem = 'textdisplay'
+        if curses.LINES >= 24 and curses.COLS >= 80:
+            break
 
-        # element has changed, add blank line
-        if elem != obj[-1]:
-            if newelem not in obj[i + 1]:
-                size_y += 1
+        # wait until terminal is large enough again
+        win.clear()
+        win.addstr(0, 0, 'At least 80x24 is needed, Q: Quit'
+                   [0:curses.COLS - 1])
+        win.refresh()
 
-        # current element requires more space, allocate it
-        if width > size_x:
-            size_x = width
+        # other keys have nothing to act on until then
+        while True:
+            ckey = raw_key(win)
 
-    # bail out if page is too large (for now)
-    if size_y > maxy:
-        draw_popup(screen, 'Page is way too large to view.')
-        return -1
+            if ckey == curses.KEY_RESIZE:
+                break
 
-    # page would be too wide
-    if size_x > maxx - 4:
-        size_x = maxx - 4
+            if ckey == ord("q") or ckey == ord("Q"):
+                clean_curses()
+                quit(0)
 
-    # calculate position, so the page is centered
-    pos_y = int(maxy / 2 - size_y / 2)
-    pos_x = int(maxx / 2 - size_x / 2)
+    draw_background(win)
 
-    # create actual window and border
-    win = curses.newwin(size_y, size_x, pos_y, pos_x)
-    win.attron(curses.A_BOLD)
-    win.border()
-    win.attroff(curses.A_BOLD)
+    PROFILER.count('relayouts')
+    PROFILER.stop('layout', t0)
 
-    # draw title
-    win.addstr(0, int(size_x / 2 - len(ptitle) / 2), ptitle)
 
-    # some help too
-    if size_x > 7:
-        win.addstr(size_y - 1, 2, 'S: Save', curses.color_pair(1))
+def read_keys(win):
+    """
+    Reads a key and drains navigation keys that are already queued, so
+    they can be applied at once and the screen is rendered only once (eg.,
+    key autorepeat over slow link). First queued key that is not a
+    navigation key is pushed back and read next time.
 
-    newelem = None
-    offset = 1
+    :param win: Curses window object.
+    :return: List of key codes.
+    """
+    keys = [read_key(win)]
 
-    # main loop that draws page
-    for i, elem in enumerate(obj):
+    if keys[0] not in NAVIGATION_KEYS:
+        return keys
 
-        # color for currently selected item
-        if i == msel:
-            cl = curses.color_pair(1)
+    win.timeout(0)
+
+    while True:
+        ckey = raw_key(win)
+
+        if ckey == -1:
+            break
+
+        if ckey not in NAVIGATION_KEYS:
+            unget_key(ckey)
+            break
+
+        keys.append(ckey)
+
+    win.timeout(INPUT_TIMEOUT)
+    PROFILER.count('coalesced keys', len(keys) - 1)
+
+    return keys
+
+
+class SchemaError(Exception):
+    """
+    Raised when YAML definition is not valid.
+    """
+    pass
+
+
+# node and element type tags
+MENU = 'menu'
+PAGE = 'page'
+CHECKBOX = 'checkbox'
+RADIO = 'radio'
+TEXTBOX = 'textbox'
+TEXTAREA = 'textarea'
+TEXTDISPLAY = 'textdisplay'
+
+ELEMENT_TYPES = (CHECKBOX, RADIO, TEXTBOX, TEXTAREA, TEXTDISPLAY)
+
+
+class Overlay(object):
+    """
+    Sparse values set on top of the compiled definition, which is never
+    changed. Values are kept by element ID and selected radio buttons by
+    RadioGroup, only when they differ from what's inherited. Overlays can
+    be layered (e.g. base, group and host profile below user edits), values
+    not found in an overlay come from its parent and then from defaults.
+    """
+    __slots__ = ('values', 'groups', 'parent')
+
+    def __init__(self, parent=None):
+        self.values = {}
+        self.groups = {}
+        self.parent = parent
+
+    def get(self, eid, default):
+        """
+        Returns value of an element.
+
+        :param eid: Element ID.
+        :param default: Default value of the element.
+        :return: Value.
+        """
+        overlay = self
+
+        while overlay is not None:
+            if eid in overlay.values:
+                return overlay.values[eid]
+            overlay = overlay.parent
+
+        return default
+
+    def set(self, eid, value, default):
+        """
+        Sets value of an element, value equal to inherited one is not kept.
+
+        :param eid: Element ID.
+        :param value: New value.
+        :param default: Default value of the element.
+        :return: None.
+        """
+        if self.parent is not None:
+            default = self.parent.get(eid, default)
+
+        if value is default or (value == default and
+                                default.__class__ is not LazyText and
+                                default.__class__ is not Blob):
+            self.values.pop(eid, None)
+        else:
+            self.values[eid] = value
+
+    def get_selected(self, group):
+        """
+        Returns selected member of radio group.
+
+        :param group: RadioGroup object.
+        :return: Element object or None.
+        """
+        overlay = self
+
+        while overlay is not None:
+            if group in overlay.groups:
+                return overlay.groups[group]
+            overlay = overlay.parent
+
+        return group.default
+
+    def set_selected(self, group, elem):
+        """
+        Sets selected member of radio group.
+
+        :param group: RadioGroup object.
+        :param elem: Element object or None.
+        :return: None.
+        """
+        if self.parent is not None:
+            inherited = self.parent.get_selected(group)
         else:
-            cl = curses.color_pair(0)
+            inherited = group.default
 
-        # this actually draws what is visible
-        if 'checkbox' in elem:
-            newelem = 'checkbox'
+        if elem is inherited:
+            self.groups.pop(group, None)
+        else:
+            self.groups[group] = elem
+
+    def select(self, group, elem):
+        """
+        Selects radio button in this overlay.
+
+        :param group: RadioGroup object.
+        :param elem: Element object.
+        :return: None.
+        """
+        for member in group.members:
+            self.set(member.eid, member is elem, member.default)
+
+        self.set_selected(group, elem)
+
+    def reset(self, elem=None):
+        """
+        Resets one element, whole radio group or everything to defaults.
+
+        :param elem: Element object, None resets everything.
+        :return: None.
+        """
+        if elem is None:
+            self.values = {}
+            self.groups = {}
+        elif elem.group is not None:
+            for member in elem.group.members:
+                self.values.pop(member.eid, None)
+            self.groups.pop(elem.group, None)
+        else:
+            self.values.pop(elem.eid, None)
 
-            if elem.get('value', False) is True:
-                win.addstr(i + offset, 1,
-                           '[*] ' + elem.get('title', '')[0:size_x - 6], cl)
-            else:
-                win.addstr(i + offset, 1,
-                           '[ ] ' + elem.get('title', '')[0:size_x - 6], cl)
-
-        elif 'radio' in elem:
-            newelem = 'radio'
-            if elem.get('value', False) is True:
-                win.addstr(i + offset, 1,
-                           '(*) ' + elem.get('title', '')[0:size_x - 6], cl)
+    def prune(self, tree):
+        """
+        Forgets edits of elements that are not in the tree anymore.
+
+        :param tree: Tree object.
+        :return: None.
+        """
+        for eid in [eid for eid in self.values if eid not in tree.elements]:
+            del self.values[eid]
+
+        for group in [group for group in self.groups
+                      if not group.members or
+                      tree.elements.get(group.members[0].eid) is not
+                      group.members[0]]:
+            del self.groups[group]
+
+
+class Element(object):
+    """
+    Compiled page element (checkbox, radio, textbox, textarea, textdisplay).
+    Radio buttons refer to their RadioGroup. Default value comes from the
+    definition, value set by user is kept in the Overlay. Large text values
+    might be LazyText or Blob objects, they are read from the file on first
+    access. Value of elements with a ValueSource comes from a command.
+    """
+    __slots__ = ('kind', 'eid', 'title', 'default', 'overlay', 'group',
+                 'depends', 'visible', 'constraints', 'preview', 'source')
+
+    def __init__(self, kind, eid, title, value):
+        self.kind = kind
+        self.eid = eid
+        self.title = title
+        self.default = value
+        self.overlay = None
+        self.group = None
+        self.depends = None
+        self.visible = True
+        self.constraints = None
+        self.preview = None
+        self.source = None
+
+    @property
+    def raw(self):
+        """
+        Value without reading lazy values from files.
+        """
+        return self.overlay.get(self.eid, self.default)
+
+    @property
+    def value(self):
+        value = self.overlay.get(self.eid, self.default)
+
+        if value.__class__ is LazyText or value.__class__ is Blob:
+            loaded = value.load()
+
+            # default is the same text, it was only read now
+            if value is self.default:
+                self.default = loaded
             else:
-                win.addstr(i + offset, 1,
-                           '( ) ' + elem.get('title', '')[0:size_x - 6], cl)
+                self.overlay.values[self.eid] = loaded
 
-        elif 'textbox' in elem:
-            newelem = 'textbox'
+            value = loaded
 
-            # value and title might be too long
-            if len(str(elem.get('title'))) + len(
-                    str(elem.get('value'))) + 4 <= size_x:
-                win.addstr(i + offset, 1, elem.get('title') + ": " + str(
-                    elem.get('value', '')), cl)
+        return value
+
+    @value.setter
+    def value(self, value):
+        self.overlay.set(self.eid, value, self.default)
+
+
+class RadioGroup(object):
+    """
+    Group of radio buttons, only one of them can be selected. Currently
+    selected member is kept, so selecting another one doesn't have to scan
+    the group. Member selected by definition is the default, selection made
+    by user is kept in the Overlay of members.
+    """
+    __slots__ = ('gid', 'members', 'default', 'overlay')
+
+    def __init__(self, gid):
+        self.gid = gid
+        self.members = []
+        self.default = None
+        self.overlay = None
+
+    @property
+    def selected(self):
+        return self.overlay.get_selected(self)
+
+    @selected.setter
+    def selected(self, elem):
+        self.overlay.set_selected(self, elem)
+
+    def add(self, elem):
+        """
+        Adds radio button to the group.
+
+        :param elem: Element object.
+        :return: None.
+        """
+        if elem.default is True:
+            if self.default is not None:
+                raise SchemaError('radio group %r: more than one option '
+                                  'selected' % self.gid)
+            self.default = elem
+
+        elem.group = self
+        self.overlay = elem.overlay
+        self.members.append(elem)
+
+    def select(self, elem):
+        """
+        Selects given member and deselects the previous one.
+
+        :param elem: Element object.
+        :return: None.
+        """
+        if self.selected is not None:
+            self.selected.value = False
+
+        elem.value = True
+        self.selected = elem
+
+
+class Constraints(object):
+    """
+    Declarative checks of textbox or textarea value (type, min, max, regex,
+    choices, max_length), compiled once when definition is loaded.
+    """
+    __slots__ = ('type', 'min', 'max', 'regex', 'choices', 'max_length')
+
+    # names of types and converters of values
+    TYPES = {'int': int, 'float': float, 'str': str}
+
+    def __init__(self, obj, where):
+        self.type = obj.get('type')
+        self.min = obj.get('min')
+        self.max = obj.get('max')
+        self.regex = obj.get('regex')
+        self.choices = obj.get('choices')
+        self.max_length = obj.get('max_length')
+
+        # ranges are numeric, pick type from them unless it's given
+        if self.type is None and (self.min is not None or
+                                  self.max is not None):
+            if isinstance(self.min, float) or isinstance(self.max, float):
+                self.type = 'float'
             else:
-                # so truncate it to fit the screen
-                spc = size_x - len(str(elem.get('title'))) - 4
+                self.type = 'int'
+
+        if self.type is not None and self.type not in self.TYPES:
+            raise SchemaError('%s: type has to be one of %s' %
+                              (where, ', '.join(sorted(self.TYPES))))
+
+        if self.type == 'str' and (self.min is not None or
+                                   self.max is not None):
+            raise SchemaError('%s: min and max need numeric type' % where)
+
+        try:
+            if self.min is not None:
+                self.min = self.TYPES[self.type](self.min)
+            if self.max is not None:
+                self.max = self.TYPES[self.type](self.max)
+        except (TypeError, ValueError):
+            raise SchemaError('%s: min and max have to be %s' %
+                              (where, self.type))
+
+        if self.regex is not None:
+            try:
+                self.regex = re.compile(str(self.regex))
+            except re.error as err:
+                raise SchemaError('%s: invalid regex: %s' % (where, err))
+
+        if self.choices is not None:
+            if not isinstance(self.choices, list) or len(self.choices) == 0:
+                raise SchemaError('%s: choices have to be non-empty list' %
+                                  where)
+            self.choices = frozenset(str(choice) for choice in self.choices)
+
+        if self.max_length is not None and \
+                (not isinstance(self.max_length, int) or self.max_length < 0):
+            raise SchemaError('%s: max_length has to be positive number' %
+                              where)
+
+    def check(self, value):
+        """
+        Checks value against all constraints.
+
+        :param value: Value of the element.
+        :return: List of problems, empty if value is fine.
+        """
+        problems = []
+        text = '' if value is None else str(value)
+
+        if self.max_length is not None and len(text) > self.max_length:
+            problems.append('longer than %d characters' % self.max_length)
+
+        if self.choices is not None and text not in self.choices:
+            problems.append('has to be one of %s' %
+                            ', '.join(sorted(self.choices)))
+
+        if self.regex is not None and self.regex.fullmatch(text) is None:
+            problems.append('does not match %s' % self.regex.pattern)
+
+        if self.type is not None:
+            try:
+                typed = self.TYPES[self.type](text)
+            except ValueError:
+                problems.append('has to be %s' % self.type)
+                return problems
+
+            if self.min is not None and typed < self.min:
+                problems.append('has to be at least %s' % self.min)
+            if self.max is not None and typed > self.max:
+                problems.append('has to be at most %s' % self.max)
+
+        return problems
+
+
+class ValueSource(object):
+    """
+    Shell command that provides value of an element or choices of a radio
+    group (source key). Output is cached for ttl seconds, elements are
+    updated whenever it changes. Radio group with source is represented by
+    a textdisplay with the group title followed by one radio button per
+    line of output.
+    """
+    __slots__ = ('command', 'ttl', 'output', 'title', 'choice', 'group')
 
-                # title is really long, truncate it
-                if spc <= 0:
-                    tmptitle = elem.get('title')[0:int(size_x / 2)] + "..."
-                    spc = size_x - len(tmptitle) - 4
-                else:
-                    tmptitle = elem.get('title')
+    def __init__(self, command, ttl):
+        self.command = command
+        self.ttl = ttl
+        self.output = None
+        self.title = None
+        self.choice = None
+        self.group = None
 
-                ln = str(elem.get('value', ' '))[0:spc]
-                ln = re.sub('...............$', '... [truncated]', ln)
-                win.addstr(i + offset, 1, tmptitle + ": " + str(ln), cl)
 
-        elif 'textarea' in elem:
-            newelem = 'textarea'
+class CommandCache(object):
+    """
+    Outputs of source commands. Each command runs in its own background
+    thread, so the UI never waits for them, expired outputs are used until
+    fresh ones arrive.
+    """
 
-            # title might be too long
-            tmptitle = str(elem.get('title', ''))[0:int(size_x / 2)]
+    def __init__(self):
+        self.results = {}
+        self.running = set()
+        self.lock = threading.Lock()
 
-            # check if there's value at all, otherwise leave space blank
-            if len(elem.get('value', '')) == 0:
-                win.addstr(i + offset, 1, tmptitle + ": ", cl)
-                offset += 1
-            elif 'value' in elem:
+    def get(self, command, ttl, wait=False):
+        """
+        Returns output of a command and starts its refresh if it's missing
+        or expired.
 
-                textlist = elem.get('value', '').rstrip().split('\n')
+        :param command: Shell command.
+        :param ttl: How long output is valid in seconds.
+        :param wait: Run the command right away if there's no output yet.
+        :return: Output or None if command did not finish yet.
+        """
+        with self.lock:
+            result = self.results.get(command)
 
-                for j, ln in enumerate(textlist):
+        if wait and result is None:
+            output = run_command(command)
 
-                    ln = ln[0:size_x - 4 - len(tmptitle)]
+            with self.lock:
+                self.results[command] = (time.monotonic(), output)
 
-                    if j == 0:
-                        win.addstr(i + offset, 1, tmptitle + ": " + str(ln),
-                                   cl)
-                        offset += 1
-                    if j == 1:
-                        if len(textlist) > 2:
-                            ln = re.sub('.............$', '... [wrapped]', ln)
-                        win.addstr(i + offset, 1 + len(tmptitle) + 2, str(ln),
-                                   cl)
-                        break
+            return output
 
-        elif 'textdisplay' in elem:
-            newelem = 'textdisplay'
+        with self.lock:
+            refresh = command not in self.running and \
+                (result is None or time.monotonic() - result[0] > ttl)
 
-            # wrapping is handled here
-            textlist = textwrap.wrap(elem.get('value', ''), size_x - 2)
+            if refresh:
+                self.running.add(command)
 
-            # print whatever is in content of textdisplay
-            for j, ln in enumerate(textlist):
+        if refresh:
+            threading.Thread(target=self.work, args=(command,),
+                             daemon=True).start()
 
-                # if it's too many lines, truncate
-                if j == 4 and len(textlist) > 4:
-                    ln = re.sub('.............$', '... [wrapped]', ln)
-                    win.addstr(i + offset, 1, str(ln), cl)
-                    break
+        return None if result is None else result[1]
 
-                # print current line
-                win.addstr(i + offset, 1, str(ln), cl)
+    def cached(self, command):
+        """
+        Returns output of a command if it's known, even expired.
 
-                if j + 1 < len(textlist):
-                    offset += 1
+        :param command: Shell command.
+        :return: Output or None.
+        """
+        with self.lock:
+            result = self.results.get(command)
 
-        # element has changed, add blank line
-        if elem != obj[-1]:
-            if newelem not in obj[i + 1]:
-                offset += 1
+        return None if result is None else result[1]
 
-    win.attroff(curses.A_BOLD)
-    win.noutrefresh()
-    curses.doupdate()
+    def pending(self):
+        """
+        Tells whether some commands are running.
 
-    ckey = screen.getch()
+        :return: True or False.
+        """
+        with self.lock:
+            return len(self.running) > 0
 
-    # read keys and update, edit value on ENTER, return -1 if leaving
-    if ckey == curses.KEY_UP:
-        if msel == 0:
-            msel = len(obj) - 1
+    def work(self, command):
+        """
+        Runs command in a background thread.
+
+        :param command: Shell command.
+        :return: None.
+        """
+        output = run_command(command)
+
+        with self.lock:
+            self.results[command] = (time.monotonic(), output)
+            self.running.discard(command)
+
+
+def run_command(command):
+    """
+    Runs source command, it can't read from or write to the terminal.
+
+    :param command: Shell command.
+    :return: Standard output, empty if command could not run or timed out.
+    """
+    try:
+        proc = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              timeout=SOURCE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return ''
+
+    return proc.stdout.decode('utf-8', 'replace')
+
+
+SOURCES = CommandCache()
+
+
+# keys of declarative constraints
+CONSTRAINT_KEYS = ('type', 'min', 'max', 'regex', 'choices', 'max_length')
+
+
+class Page(object):
+    """
+    Compiled page, its content is a list of Element objects. Digest of the
+    source is kept only when the definition is watched for changes. Shown
+    is a list of visible elements, it's filled when page is opened. Sources
+    are elements whose values come from commands.
+    """
+    __slots__ = ('kind', 'nid', 'title', 'on_save', 'content', 'digest',
+                 'depends', 'visible', 'shown', 'sources')
+
+    def __init__(self, nid, title, on_save):
+        self.kind = PAGE
+        self.nid = nid
+        self.title = title
+        self.on_save = on_save
+        self.content = []
+        self.digest = None
+        self.depends = None
+        self.visible = True
+        self.shown = None
+        self.sources = []
+
+
+class Menu(object):
+    """
+    Compiled menu, its content is a list of Menu and Page objects. Lists of
+    IDs and titles, width and rendered rows are filled when it's first shown.
+    """
+    __slots__ = ('kind', 'nid', 'title', 'content', 'ids', 'titles',
+                 'width', 'rows', 'depends', 'visible')
+
+    def __init__(self, nid, title):
+        self.kind = MENU
+        self.nid = nid
+        self.title = title
+        self.content = []
+        self.depends = None
+        self.visible = True
+        self.ids = None
+        self.titles = None
+        self.width = 0
+        self.rows = None
+
+
+class Tree(object):
+    """
+    Compiled YAML definition with index of all menus, pages and elements.
+    Parents map ID of each menu, page and element to ID of menu or page
+    that contains it. Conditions are compiled depends_on expressions,
+    dependents map element ID to IDs that depend on it and ranks give
+    topological order of the dependency graph.
+    """
+    __slots__ = ('root', 'nodes', 'parents', 'elements', 'commands',
+                 'loader', 'conditions', 'dependents', 'ranks', 'blobs',
+                 'overlay')
+
+    def __init__(self, commands=None):
+        self.root = None
+        self.nodes = {}
+        self.parents = {}
+        self.elements = {}
+        self.commands = commands
+        self.loader = 'dict'
+        self.blobs = None
+        self.conditions = {}
+        self.dependents = {}
+        self.ranks = {}
+        self.overlay = Overlay()
+
+
+def compile_tree(yamlobj, old=None, digests=False, blobs=None):
+    """
+    Validates YAML definition and compiles it into Menu, Page and Element
+    objects. When previous Tree is given, pages that did not change are
+    taken over from it including values set by user, changed pages are
+    compiled again and keep values user edited.
+
+    :param yamlobj: Python object ( nested lists / dicts ).
+    :param old: Previously compiled Tree object or None.
+    :param digests: Keep digest of each page, so it can be reused later.
+    :param blobs: Directory of blobs referenced by textarea values.
+    :return: Tree object.
+    """
+    t0 = PROFILER.start()
+
+    if not isinstance(yamlobj, dict) or MENU not in yamlobj:
+        raise SchemaError('top level object has to be a menu')
+
+    tree = Tree(yamlobj.get('commands'))
+    tree.blobs = blobs
+
+    # user edits are kept across reloads
+    if old is not None:
+        tree.overlay = old.overlay
+
+    tree.root = compile_node(tree, yamlobj, 'top level', old,
+                             digests or old is not None)
+    tree.overlay.prune(tree)
+    compile_depends(tree)
+
+    PROFILER.record('compile_tree', t0)
+
+    return tree
+
+
+def check_id(tree, objid, where):
+    """
+    Makes sure that ID is valid and was not used yet.
+
+    :param tree: Tree object being compiled.
+    :param objid: YAML ID of given node or element.
+    :param where: Location of the object, used in error messages.
+    :return: None.
+    """
+    if objid is None or isinstance(objid, (dict, list)):
+        raise SchemaError('%s: invalid ID %r' % (where, objid))
+
+    if objid in tree.nodes or objid in tree.elements:
+        raise SchemaError('%s: duplicate ID %r' % (where, objid))
+
+
+def compile_node(tree, obj, where, old=None, digests=False):
+    """
+    Compiles menu or page including its content.
+
+    :param tree: Tree object being compiled.
+    :param obj: Python object ( nested lists / dicts ).
+    :param where: Location of the object, used in error messages.
+    :param old: Previously compiled Tree object or None.
+    :param digests: Keep digest of each page.
+    :return: Menu or Page object.
+    """
+    if not isinstance(obj, dict):
+        raise SchemaError('%s: menu or page expected' % where)
+
+    if MENU in obj:
+        kind = MENU
+    elif PAGE in obj:
+        kind = PAGE
+    else:
+        raise SchemaError('%s: menu or page expected' % where)
+
+    nid = intern_str(obj[kind])
+    check_id(tree, nid, where)
+    where = '%s %r' % (kind, nid)
+
+    if obj.get('title') is None:
+        raise SchemaError('%s: missing title' % where)
+
+    content = obj.get('content')
+
+    if not isinstance(content, list) or len(content) == 0:
+        raise SchemaError('%s: content has to be non-empty list' % where)
+
+    if kind == MENU:
+        node = Menu(nid, intern_str(str(obj['title'])))
+        node.depends = obj.get('depends_on')
+        tree.nodes[nid] = node
+
+        for i, child in enumerate(content):
+            child = compile_node(tree, child, 'content[%d] of %s' % (i, where),
+                                 old, digests)
+            tree.parents[child.nid] = nid
+            node.content.append(child)
+    else:
+        digest = hash(repr(obj)) if digests else None
+        prev = old.nodes.get(nid) if old is not None else None
+
+        # page did not change, take it over as it is
+        if prev is not None and prev.kind == PAGE and \
+                prev.digest == digest:
+            tree.nodes[nid] = prev
+            prev.shown = None
+            for elem in prev.content:
+                check_id(tree, elem.eid, 'content of %s' % where)
+                tree.elements[elem.eid] = elem
+                tree.parents[elem.eid] = nid
+            return prev
+
+        node = Page(nid, intern_str(str(obj['title'])), obj.get('on_save'))
+        node.digest = digest
+        node.depends = obj.get('depends_on')
+        tree.nodes[nid] = node
+
+        groups = {}
+        adjacent = None
+
+        for i, raw in enumerate(content):
+            elem = compile_element(tree, raw, 'content[%d] of %s' % (i, where))
+            tree.parents[elem.eid] = nid
+            node.content.append(elem)
+
+            if elem.source is not None:
+                node.sources.append(elem)
+
+            if elem.kind != RADIO:
+                adjacent = None
+                continue
+
+            # radios without group key are grouped with adjacent radios
+            gid = raw.get('group')
+
+            if gid is None:
+                if adjacent is None:
+                    adjacent = RadioGroup(elem.eid)
+                group = adjacent
+            else:
+                adjacent = None
+                if gid not in groups:
+                    groups[gid] = RadioGroup(gid)
+                group = groups[gid]
+
+            group.add(elem)
+
+        # outputs known from before are used right away
+        for elem in node.sources:
+            output = SOURCES.cached(elem.source.command)
+            if output is not None:
+                apply_source(tree, node, elem, output)
+
+        if old is not None:
+            keep_edits(old, node)
+
+    return node
+
+
+def keep_edits(old, page):
+    """
+    Makes values that user edited in previous version of the tree fit a
+    recompiled page. Edits are shared through the Overlay, only those of
+    elements that changed their kind are dropped and radio buttons are
+    selected again in the new groups.
+
+    :param old: Previously compiled Tree object.
+    :param page: Newly compiled Page object.
+    :return: None.
+    """
+    overlay = old.overlay
+
+    for elem in page.content:
+        if elem.eid not in overlay.values:
+            continue
+
+        prev = old.elements.get(elem.eid)
+
+        if prev is None or prev.kind != elem.kind:
+            del overlay.values[elem.eid]
+        elif elem.kind == RADIO and overlay.values[elem.eid] is True:
+            elem.group.select(elem)
+
+    # selected button of a group might have been deselected by user
+    for elem in page.content:
+        group = elem.group
+
+        if group is not None and group.selected is not None and \
+                group.selected.value is not True:
+            overlay.reset(elem)
+
+
+def compile_element(tree, obj, where):
+    """
+    Compiles single page element.
+
+    :param tree: Tree object being compiled.
+    :param obj: Python dictionary.
+    :param where: Location of the element, used in error messages.
+    :return: Element object.
+    """
+    if not isinstance(obj, dict):
+        raise SchemaError('%s: element expected' % where)
+
+    kinds = [kind for kind in ELEMENT_TYPES if kind in obj]
+
+    if len(kinds) != 1:
+        raise SchemaError('%s: element needs exactly one of %s' %
+                          (where, ', '.join(ELEMENT_TYPES)))
+
+    kind = kinds[0]
+    eid = intern_str(obj[kind])
+    check_id(tree, eid, where)
+    where = '%s %r' % (kind, eid)
+
+    if 'group' in obj and kind != RADIO:
+        raise SchemaError('%s: only radio can be part of a group' % where)
+
+    value = obj.get('value')
+    title = obj.get('title')
+    source = compile_source(obj, kind, where)
+
+    if source is not None and kind == RADIO:
+        # choices are filled in from the output later
+        if 'group' in obj or 'depends_on' in obj:
+            raise SchemaError('%s: group and depends_on not allowed on radio '
+                              'with source' % where)
+        if title is None:
+            raise SchemaError('%s: missing title' % where)
+
+        source.title = intern_str(str(title))
+        source.choice = None if value is None else str(value)
+        source.group = RadioGroup(eid)
+        source.group.overlay = tree.overlay
+        kind = TEXTDISPLAY
+        title = ''
+        value = '%s: %s' % (source.title, SOURCE_LOADING)
+    elif kind == TEXTDISPLAY and value is None and source is not None:
+        value = ''
+
+    if kind == TEXTDISPLAY:
+        if value is None:
+            raise SchemaError('%s: missing value' % where)
+        if not isinstance(value, LazyText):
+            value = str(value)
+        title = ''
+    elif title is None:
+        raise SchemaError('%s: missing title' % where)
+    elif kind in (TEXTBOX, TEXTAREA) and value is None:
+        value = ''
+    elif kind == TEXTAREA and isinstance(value, dict):
+        # value stored out of line, e.g. {blob: <sha256>}
+        if not isinstance(value.get('blob'), str) or tree.blobs is None:
+            raise SchemaError('%s: invalid blob reference' % where)
+        value = Blob(os.path.join(tree.blobs, value['blob']), value['blob'])
+    elif kind == RADIO:
+        value = value is True
+
+    constrained = [key for key in CONSTRAINT_KEYS if key in obj]
+
+    if len(constrained) > 0 and kind not in (TEXTBOX, TEXTAREA):
+        raise SchemaError('%s: %s allowed only on textbox and textarea' %
+                          (where, ', '.join(constrained)))
+
+    elem = Element(kind, eid, intern_str(str(title)), value)
+    elem.overlay = tree.overlay
+    elem.depends = obj.get('depends_on')
+    elem.source = source
+
+    if len(constrained) > 0:
+        elem.constraints = Constraints(obj, where)
+    tree.elements[eid] = elem
+
+    return elem
+
+
+def compile_source(obj, kind, where):
+    """
+    Compiles source and ttl keys of an element.
+
+    :param obj: Python dictionary.
+    :param kind: Kind of the element.
+    :param where: Location of the element, used in error messages.
+    :return: ValueSource object or None.
+    """
+    command = obj.get('source')
+    ttl = obj.get('ttl')
+
+    if command is None:
+        if ttl is not None:
+            raise SchemaError('%s: ttl allowed only with source' % where)
+        return None
+
+    if kind == CHECKBOX:
+        raise SchemaError('%s: source not allowed on checkbox' % where)
+
+    if not isinstance(command, str) or command.strip() == '':
+        raise SchemaError('%s: source has to be a command' % where)
+
+    if ttl is None:
+        ttl = SOURCE_TTL
+    elif isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or \
+            ttl <= 0:
+        raise SchemaError('%s: ttl has to be a positive number' % where)
+
+    return ValueSource(command, ttl)
+
+
+# tokens of depends_on expressions
+DEPENDS_TOKEN = re.compile(r'\s*(?:(&&|\|\||!=|=|!|\(|\))|"([^"]*)"|'
+                           r"'([^']*)'|([^\s&|!=()\"']+))")
+
+
+def parse_depends(text, where):
+    """
+    Parses depends_on expression. Expressions are made of element IDs,
+    comparisons ID = value and ID != value, operators !, && and || and
+    parentheses, e.g. 'ext_4 && !ext_4_journal || fs_type = xfs'.
+
+    :param text: Expression.
+    :param where: Location of the expression, used in error messages.
+    :return: Tuple of expression tree and set of IDs used in it.
+    """
+    if not isinstance(text, str):
+        raise SchemaError('%s: depends_on has to be a string' % where)
+
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+
+    while pos < len(text):
+        match = DEPENDS_TOKEN.match(text, pos)
+
+        if match is None:
+            raise SchemaError('%s: invalid depends_on %r' % (where, text))
+
+        op, dquoted, squoted, word = match.groups()
+
+        if op is not None:
+            tokens.append(('op', op))
+        elif word is not None:
+            tokens.append(('word', word))
         else:
-            msel -= 1
-    elif ckey == curses.KEY_DOWN:
-        if msel == len(obj) - 1:
-            msel = 0
+            tokens.append(('str', dquoted if squoted is None else squoted))
+
+        pos = match.end()
+
+    symbols = set()
+
+    def error():
+        return SchemaError('%s: invalid depends_on %r' % (where, text))
+
+    def parse_or(i):
+        left, i = parse_and(i)
+        while i < len(tokens) and tokens[i] == ('op', '||'):
+            right, i = parse_and(i + 1)
+            left = ('or', left, right)
+        return left, i
+
+    def parse_and(i):
+        left, i = parse_unary(i)
+        while i < len(tokens) and tokens[i] == ('op', '&&'):
+            right, i = parse_unary(i + 1)
+            left = ('and', left, right)
+        return left, i
+
+    def parse_unary(i):
+        if i >= len(tokens):
+            raise error()
+
+        if tokens[i] == ('op', '!'):
+            expr, i = parse_unary(i + 1)
+            return ('not', expr), i
+
+        if tokens[i] == ('op', '('):
+            expr, i = parse_or(i + 1)
+            if i >= len(tokens) or tokens[i] != ('op', ')'):
+                raise error()
+            return expr, i + 1
+
+        if tokens[i][0] != 'word':
+            raise error()
+
+        symbol = tokens[i][1]
+        symbols.add(symbol)
+
+        # comparison with a value
+        if i + 1 < len(tokens) and tokens[i + 1] in (('op', '='),
+                                                     ('op', '!=')):
+            if i + 2 >= len(tokens) or tokens[i + 2][0] == 'op':
+                raise error()
+            op = 'eq' if tokens[i + 1][1] == '=' else 'ne'
+            return (op, symbol, tokens[i + 2][1]), i + 3
+
+        return ('sym', symbol), i + 1
+
+    expr, i = parse_or(0)
+
+    if i != len(tokens):
+        raise error()
+
+    return expr, symbols
+
+
+def compile_depends(tree):
+    """
+    Compiles depends_on expressions of all menus, pages and elements into
+    dependency graph, orders it topologically and evaluates visibility of
+    everything that depends on something.
+
+    :param tree: Tree object.
+    :return: None.
+    """
+    tree.conditions = {}
+    tree.dependents = {}
+    tree.ranks = {}
+    waiting = {}
+
+    for objid, obj in list(tree.nodes.items()) + list(tree.elements.items()):
+        if obj.depends is None:
+            continue
+
+        where = '%s %r' % (obj.kind, objid)
+        expr, symbols = parse_depends(obj.depends, where)
+
+        for symbol in symbols:
+            if symbol not in tree.elements:
+                raise SchemaError('%s: depends on unknown element %r' %
+                                  (where, symbol))
+            tree.dependents.setdefault(symbol, []).append(objid)
+
+        tree.conditions[objid] = expr
+        waiting[objid] = len(symbols)
+
+    # elements nothing depends on come first, then their dependents
+    ready = [objid for objid in tree.dependents if objid not in waiting]
+
+    while len(ready) > 0:
+        objid = ready.pop()
+        tree.ranks[objid] = len(tree.ranks)
+
+        for dep in tree.dependents.get(objid, ()):
+            waiting[dep] -= 1
+            if waiting[dep] == 0:
+                ready.append(dep)
+
+    cycle = sorted(str(objid) for objid in waiting
+                   if objid not in tree.ranks)
+
+    if len(cycle) > 0:
+        raise SchemaError('circular depends_on between %s' % ', '.join(cycle))
+
+    evaluate_visibility(tree)
+
+
+def evaluate_visibility(tree):
+    """
+    Evaluates visibility of everything that depends on something from
+    scratch, used when many values changed at once.
+
+    :param tree: Tree object.
+    :return: None.
+    """
+    for objid in sorted(tree.conditions, key=tree.ranks.get):
+        obj = tree.nodes.get(objid) or tree.elements[objid]
+        obj.visible = eval_depends(tree, tree.conditions[objid])
+
+    # cached lists of visible menu items and page elements are stale
+    for node in tree.nodes.values():
+        if node.kind == PAGE:
+            node.shown = None
         else:
-            msel += 1
-    elif ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
-        set_value(obj, msel, screen)
+            node.ids = None
+
+
+def eval_depends(tree, expr):
+    """
+    Evaluates compiled depends_on expression. Hidden elements count as
+    unchecked or empty, sourced radio group has the value of its selected
+    choice.
+
+    :param tree: Tree object.
+    :param expr: Expression tree from parse_depends().
+    :return: True or False.
+    """
+    op = expr[0]
+
+    if op == 'not':
+        return not eval_depends(tree, expr[1])
+    if op == 'and':
+        return eval_depends(tree, expr[1]) and eval_depends(tree, expr[2])
+    if op == 'or':
+        return eval_depends(tree, expr[1]) or eval_depends(tree, expr[2])
+
+    elem = tree.elements[expr[1]]
+
+    if elem.source is not None and elem.source.group is not None:
+        # sourced radio group stands for its selected choice
+        selected = elem.source.group.selected
+        value = '' if selected is None else selected.title
+    elif elem.kind == CHECKBOX or elem.kind == RADIO:
+        value = 'y' if elem.visible and elem.value is True else 'n'
+    elif elem.visible and elem.value is not None:
+        value = str(elem.value)
+    else:
+        value = ''
+
+    if op == 'eq':
+        return value == expr[2]
+    if op == 'ne':
+        return value != expr[2]
+
+    return value != '' and value != 'n'
+
+
+def update_visibility(tree, eids):
+    """
+    Re-evaluates visibility of everything that depends on changed elements,
+    in topological order, so each affected node is evaluated once. Cached
+    lists of whatever contains nodes that changed are dropped.
+
+    :param tree: Tree object.
+    :param eids: IDs of elements whose value changed.
+    :return: List of IDs whose visibility changed.
+    """
+    heap = []
+    queued = set()
+    changed = []
+
+    def push(objid):
+        for dep in tree.dependents.get(objid, ()):
+            if dep not in queued:
+                queued.add(dep)
+                heapq.heappush(heap, (tree.ranks[dep], dep))
+
+    for eid in eids:
+        push(eid)
+
+        # choices of sourced radio group are referred to by the group ID
+        elem = tree.elements.get(eid)
+
+        if elem is not None and elem.group is not None and \
+                sourced_choice(tree, tree.parents.get(eid), eid):
+            push(elem.group.gid)
+
+    while len(heap) > 0:
+        objid = heapq.heappop(heap)[1]
+        obj = tree.nodes.get(objid) or tree.elements[objid]
+        visible = eval_depends(tree, tree.conditions[objid])
+
+        if visible == obj.visible:
+            continue
+
+        obj.visible = visible
+        changed.append(objid)
+
+        # content of parent has to be listed again
+        parent = tree.nodes.get(tree.parents.get(objid))
+
+        if parent is not None and parent.kind == MENU:
+            parent.ids = None
+        elif parent is not None:
+            parent.shown = None
+
+        push(objid)
+
+    PROFILER.count('visibility evaluations', len(queued))
+
+    return changed
+
+
+def shown_content(page):
+    """
+    Returns visible elements of a page, list is kept until visibility of
+    some of them changes.
+
+    :param page: Page object.
+    :return: List of Element objects.
+    """
+    if page.shown is None:
+        page.shown = [elem for elem in page.content if elem.visible]
+
+    return page.shown
+
+
+def apply_sources(tree, page, wait=False):
+    """
+    Updates elements of a page from outputs of their source commands and
+    starts refresh of expired ones. Everything that depends on elements
+    that changed is re-evaluated.
+
+    :param tree: Tree object.
+    :param page: Page object.
+    :param wait: Run commands that have no output yet right away.
+    :return: True if some commands are still running.
+    """
+    changed = []
+
+    for elem in page.sources:
+        source = elem.source
+        output = SOURCES.get(source.command, source.ttl, wait)
+
+        if output is not None and output != source.output:
+            changed.extend(apply_source(tree, page, elem, output))
+
+    if len(changed) > 0:
+        PAGE_LAYOUTS.pop(page.nid, None)
+        update_visibility(tree, changed)
+
+    return SOURCES.pending()
+
+
+def apply_source(tree, page, elem, output):
+    """
+    Sets value of a sourced element, or choices of a sourced radio group,
+    from command output.
+
+    :param tree: Tree object.
+    :param page: Page object the element belongs to.
+    :param elem: Element object.
+    :param output: Command output.
+    :return: List of IDs of elements that changed.
+    """
+    elem.source.output = output
+
+    if elem.source.group is not None:
+        return set_choices(tree, page, elem, output)
+
+    if elem.kind == TEXTBOX:
+        lines = output.splitlines()
+        elem.default = lines[0] if len(lines) > 0 else ''
+    else:
+        elem.default = output.rstrip('\n')
+
+    return [elem.eid]
+
+
+def set_choices(tree, page, holder, output):
+    """
+    Replaces radio buttons of a sourced group with non-empty lines of
+    command output. Buttons of choices that remain are kept with their
+    values, new ones get ID <group ID>.<choice>.
+
+    :param tree: Tree object.
+    :param page: Page object the group belongs to.
+    :param holder: Textdisplay element that stands for the group.
+    :param output: Command output.
+    :return: List of IDs of elements that changed.
+    """
+    source = holder.source
+    group = source.group
+    selected = group.selected
+    members = dict((elem.title, elem) for elem in group.members)
+    choices = []
+
+    for line in output.splitlines():
+        line = line.strip()
+        if line != '' and line not in choices:
+            choices.append(intern_str(line))
+
+    group.members = []
+    group.default = None
+
+    for choice in choices:
+        elem = members.pop(choice, None)
+
+        if elem is None:
+            eid = intern_str('%s.%s' % (holder.eid, choice))
+
+            # don't take over ID of another element
+            if eid in tree.elements:
+                continue
+
+            elem = Element(RADIO, eid, choice, choice == source.choice)
+            elem.overlay = tree.overlay
+            tree.elements[eid] = elem
+            tree.parents[eid] = page.nid
+
+        group.add(elem)
+
+    # choices that disappeared take their values with them
+    for elem in members.values():
+        tree.elements.pop(elem.eid, None)
+        tree.parents.pop(elem.eid, None)
+        tree.overlay.values.pop(elem.eid, None)
+
+    if selected is not None and selected.eid not in tree.elements:
+        tree.overlay.groups.pop(group, None)
+
+    # saved selection might be a choice that has only appeared now
+    for elem in group.members:
+        if tree.overlay.values.get(elem.eid) is True and \
+                group.selected is not elem:
+            group.select(elem)
+
+    content = [elem for elem in page.content if elem.group is not group]
+    pos = content.index(holder) + 1
+    content[pos:pos] = group.members
+    page.content = content
+    page.shown = None
+
+    if len(choices) > 0:
+        holder.default = '%s:' % source.title
+    else:
+        holder.default = '%s: none' % source.title
+
+    return [holder.eid] + [elem.eid for elem in group.members]
+
+
+def wait_sources(tree):
+    """
+    Fills in values of all sourced elements, waiting for their commands,
+    used when there's no UI to show them later. Commands run concurrently.
+
+    :param tree: Tree object.
+    :return: None.
+    """
+    pages = [node for node in tree.nodes.values()
+             if node.kind == PAGE and len(node.sources) > 0]
+    done = len(pages) == 0
+
+    while True:
+        for page in pages:
+            apply_sources(tree, page)
+
+        if done:
+            break
+
+        time.sleep(SOURCE_POLL / 1000)
+        done = not SOURCES.pending()
+
+
+def shown_value(elem):
+    """
+    Returns value of an element as it's shown, placeholder is shown for
+    sourced values until their command finishes.
+
+    :param elem: Element object.
+    :return: Value.
+    """
+    if elem.source is not None and elem.source.output is None and \
+            elem.raw is elem.default and elem.source.group is None:
+        return SOURCE_LOADING
+
+    return elem.value
+
+
+def check_page(page, values=None):
+    """
+    Checks constraints of all visible elements of a page in one pass.
+
+    :param page: Page object.
+    :param values: Dictionary of values to check instead of current ones.
+    :return: List of (element ID, problem) tuples.
+    """
+    problems = []
+
+    for elem in page.content:
+        if elem.constraints is not None and elem.visible:
+            if values is None:
+                value = elem.value
+            else:
+                value = values.get(elem.eid, elem.value)
+
+            for problem in elem.constraints.check(value):
+                problems.append((elem.eid, problem))
+
+    return problems
+
+
+def check_tree(tree):
+    """
+    Checks constraints of all visible pages.
+
+    :param tree: Tree object.
+    :return: Dictionary of page ID and list of its problems, only pages with
+             problems are included.
+    """
+    t0 = PROFILER.start()
+    result = {}
+
+    for node in tree.nodes.values():
+        if node.kind == PAGE and node.visible:
+            problems = check_page(node)
+            if len(problems) > 0:
+                result[node.nid] = problems
+
+    PROFILER.record('check_tree', t0)
+
+    return result
+
+
+def format_problems(tree, problems):
+    """
+    Describes problems found by check_page().
+
+    :param tree: Tree object.
+    :param problems: List of (element ID, problem) tuples.
+    :return: String, one problem per line.
+    """
+    return '\n'.join('%s: %s' % (tree.elements[eid].title or eid, problem)
+                     for eid, problem in problems)
+
+
+def page_values(page):
+    """
+    Collects values of a page the way on_save functions get them.
+
+    :param page: Page object.
+    :return: Dictionary of element ID and value.
+    """
+    values = {}
+
+    for elem in page.content:
+        if elem.kind != TEXTDISPLAY:
+            values[elem.eid] = "" if elem.value is None else elem.value
+
+    return values
+
+
+def validate_page(tree, page, values=None):
+    """
+    Runs on_save function and constraints of a page on copy of its values,
+    so nothing in the UI changes.
+
+    :param tree: Tree object.
+    :param page: Page object.
+    :param values: Values to validate, on_save function may change them,
+                   page_values() of the page by default.
+    :return: Tuple of on_save log, list of (element ID, problem) tuples and
+             error message if on_save function failed, otherwise None.
+    """
+    if values is None:
+        values = page_values(page)
+
+    log = ""
+    error = None
+    save_func = page.on_save
+
+    if save_func in globals():
+        t0 = PROFILER.start()
+        try:
+            log = globals()[save_func](values) or ""
+        except Exception as err:
+            error = '%s failed: %s: %s' % (save_func, type(err).__name__,
+                                           err)
+        PROFILER.record('validator ' + save_func, t0)
+
+    return str(log), check_page(page, values), error
+
+
+def validate_tree(tree, jobs=None, progress=None):
+    """
+    Validates all visible pages concurrently.
+
+    :param tree: Tree object.
+    :param jobs: Number of worker threads, None picks default.
+    :param progress: Function called with number of finished pages, number
+                     of all pages and ID of the last one.
+    :return: Dictionary of page ID and validate_page() result, only pages
+             that failed or logged something are included.
+    """
+    t0 = PROFILER.start()
+    pages = [node for node in tree.nodes.values()
+             if node.kind == PAGE and node.visible]
+    results = {}
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = dict((pool.submit(validate_page, tree, page), page.nid)
+                       for page in pages)
+
+        for done, future in enumerate(
+                concurrent.futures.as_completed(futures)):
+            pid = futures[future]
+            log, problems, error = future.result()
+
+            if len(log) != 0 or len(problems) != 0 or error is not None:
+                results[pid] = (log, problems, error)
+
+            if progress is not None:
+                progress(done + 1, len(pages), pid)
+
+    PROFILER.record('validate_tree', t0)
+
+    # keep order of the definition
+    return dict((nid, results[nid]) for nid in tree.nodes if nid in results)
+
+
+def validation_failed(result):
+    """
+    Tells whether validate_page() result is a failure or just a log.
+
+    :param result: Tuple returned by validate_page().
+    :return: True or False.
+    """
+    return len(result[1]) != 0 or result[2] is not None
+
+
+def format_validation(tree, pid, result):
+    """
+    Describes validate_page() result.
+
+    :param tree: Tree object.
+    :param pid: Page ID.
+    :param result: Tuple returned by validate_page().
+    :return: String.
+    """
+    log, problems, error = result
+    lines = []
+
+    if error is not None:
+        lines.append(error)
+    if len(log) != 0:
+        lines.append(log)
+    if len(problems) != 0:
+        lines.append(format_problems(tree, problems))
+
+    return '\n'.join(lines)
+
+
+class FileWatcher(object):
+    """
+    Watches files for changes in a background thread. Uses inotify where
+    available, otherwise files are polled with os.stat(). Directories are
+    watched instead of files, so editors that replace the file on save are
+    noticed too.
+    """
+
+    # inotify event masks
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, paths, interval=1.0, settle=0.2):
+        self.paths = set(os.path.abspath(path) for path in paths)
+        self.interval = interval
+        self.settle = settle
+        self.changed = set()
+        self.last = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """
+        Starts watching in background.
+
+        :return: None.
+        """
+        self.thread.start()
+
+    def notify(self, path):
+        """
+        Marks file as changed.
+
+        :param path: Absolute path of the file.
+        :return: None.
+        """
+        with self.lock:
+            self.changed.add(path)
+            self.last = time.time()
+
+    def pending(self):
+        """
+        Checks whether some files changed and were not written for a while,
+        so they are probably complete.
+
+        :return: True if there are changes to pick up.
+        """
+        with self.lock:
+            return len(self.changed) != 0 and \
+                time.time() - self.last >= self.settle
+
+    def poll(self):
+        """
+        Returns changed files and forgets about them.
+
+        :return: Set of absolute paths.
+        """
+        with self.lock:
+            changed = self.changed
+            self.changed = set()
+            return changed
+
+    def run(self):
+        """
+        Thread body, picks inotify or stat polling.
+
+        :return: None.
+        """
+        fd, watches = self.inotify_init()
+
+        if fd is None:
+            self.run_stat()
+        else:
+            self.run_inotify(fd, watches)
+
+    def inotify_init(self):
+        """
+        Sets up inotify watches for directories of watched files.
+
+        :return: Tuple of inotify descriptor and dict of watched directories
+                 (None, None if inotify is not available).
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError, TypeError):
+            return None, None
+
+        if fd < 0:
+            return None, None
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | \
+            self.IN_CREATE
+        watches = {}
+
+        for dirname in set(os.path.dirname(path) for path in self.paths):
+            wd = libc.inotify_add_watch(fd, dirname.encode(), mask)
+
+            if wd < 0:
+                os.close(fd)
+                return None, None
+
+            watches[wd] = dirname
+
+        return fd, watches
+
+    def run_inotify(self, fd, watches):
+        """
+        Reads inotify events and marks watched files as changed.
+
+        :param fd: Inotify descriptor.
+        :param watches: Dict of watch descriptors and directories.
+        :return: None.
+        """
+        while True:
+            buf = os.read(fd, 65536)
+            pos = 0
+
+            while pos + 16 <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, pos)
+                name = buf[pos + 16:pos + 16 + length].rstrip(b'\0')
+                pos += 16 + length
+
+                path = os.path.join(watches.get(wd, ''), name.decode())
+
+                if path in self.paths:
+                    self.notify(path)
+
+    def stat(self, path):
+        """
+        Returns what is compared when files are polled.
+
+        :param path: Absolute path of the file.
+        :return: Tuple of modification time, size and inode or None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def run_stat(self):
+        """
+        Polls watched files with os.stat().
+
+        :return: None.
+        """
+        stamps = dict((path, self.stat(path)) for path in self.paths)
+
+        while True:
+            time.sleep(self.interval)
+
+            for path in self.paths:
+                stamp = self.stat(path)
+
+                if stamp != stamps[path]:
+                    stamps[path] = stamp
+                    self.notify(path)
+
+
+# watcher of definition and service functions, enabled with --watch
+WATCHER = None
+
+
+class Reload(Exception):
+    """
+    Raised from menu when watched files changed and definition has to be
+    reloaded.
+    """
+
+    def __init__(self, msel):
+        Exception.__init__(self)
+        self.msel = msel
+
+
+class ValidateAll(Exception):
+    """
+    Raised from menu when user wants to validate all pages.
+    """
+
+    def __init__(self, msel):
+        Exception.__init__(self)
+        self.msel = msel
+
+
+class Loaded(Exception):
+    """
+    Raised from root menu shown during startup when the definition has
+    finished loading or when it's needed to handle a key.
+    """
+
+    def __init__(self, msel):
+        Exception.__init__(self)
+        self.msel = msel
+
+
+class Startup(object):
+    """
+    Compiles definition and imports service functions in background
+    threads, so the UI can be started meanwhile. Exceptions of either of
+    them are raised again by wait().
+    """
+
+    def __init__(self, fn, loader, digests, functions=True):
+        self.results = {}
+        self.threads = [threading.Thread(target=self.run, daemon=True,
+                                         args=('tree', load_tree, fn, loader,
+                                               None, digests))]
+
+        if functions:
+            self.threads.append(
+                threading.Thread(target=self.run, daemon=True,
+                                 args=('functions', load_service_functions,
+                                       fn, globals())))
+
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, name, func, *args):
+        """
+        Runs one part of the startup and keeps its result or exception.
+
+        :param name: Name of the part.
+        :param func: Function to run.
+        :param args: Its arguments.
+        :return: None.
+        """
+        t0 = PROFILER.start()
+
+        try:
+            self.results[name] = (func(*args), None)
+        except Exception as err:
+            self.results[name] = (None, err)
+
+        PROFILER.record('startup ' + name, t0)
+
+    def done(self):
+        """
+        Tells whether everything is loaded.
+
+        :return: True or False.
+        """
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def wait(self):
+        """
+        Waits until everything is loaded.
+
+        :return: Tree object.
+        """
+        for thread in self.threads:
+            thread.join()
+
+        # errors in definition are reported first
+        for name in ('tree', 'functions'):
+            if name in self.results and self.results[name][1] is not None:
+                raise self.results[name][1]
+
+        return self.results['tree'][0]
+
+
+# definition being loaded while root menu is already shown
+STARTUP = None
+
+
+def reload_definition(screen, fn, tree):
+    """
+    Picks up changes of watched files and reloads definition and service
+    functions. Previous tree is kept if new definition is not valid.
+
+    :param screen: Curses screen object.
+    :param fn: Filename of input file.
+    :param tree: Currently used Tree object.
+    :return: Tree object.
+    """
+    changed = WATCHER.poll()
+
+    if os.path.abspath(re.sub('.yaml$', '.py', fn)) in changed:
+        try:
+            load_service_functions(fn, globals())
+        except Exception as err:
+            draw_popup(screen, 'Reload of service functions failed: %s' % err)
+
+    if os.path.abspath(fn) in changed:
+        try:
+            tree = load_tree(fn, tree.loader, tree)
+
+            # profile is built again from elements of the new tree
+            if HOST is not None:
+                use_host(tree, *HOST)
+        except (SchemaError, yaml.YAMLError, OSError) as err:
+            draw_popup(screen, 'Reload of %s failed: %s' % (fn, err))
+
+    return tree
+
+
+def restore_menu(tree, mhist):
+    """
+    Finds menus from history in reloaded tree, menus that are gone are
+    dropped.
+
+    :param tree: Tree object.
+    :param mhist: Menu history, list of IDs.
+    :return: Tuple of new history and current Menu object.
+    """
+    mhist = [mid for mid in mhist
+             if mid in tree.nodes and tree.nodes[mid].kind == MENU]
+
+    if len(mhist) == 0 or mhist[0] != tree.root.nid:
+        mhist.insert(0, tree.root.nid)
+
+    return mhist, tree.nodes[mhist[-1]]
+
+
+def resolve_target(tree, target):
+    """
+    Finds menu or page given by ID or by path of IDs separated by slashes,
+    e.g. 'bus_opts/pci_access_mode'. Path may start with ID of top menu.
+
+    :param tree: Tree object.
+    :param target: ID or path.
+    :return: List of IDs from top menu to the target.
+    """
+    names = [name for name in target.split('/') if name != '']
+
+    if len(names) == 0:
+        raise SchemaError('empty path %r' % target)
+
+    if names[-1] not in tree.nodes:
+        raise SchemaError('no menu or page %r' % names[-1])
+
+    # walk parents from target up to top menu
+    path = [names[-1]]
+
+    while path[-1] in tree.parents:
+        path.append(tree.parents[path[-1]])
+
+    path.reverse()
+
+    # given path has to match the real one
+    if len(names) > 1 and names != path and names != path[1:]:
+        raise SchemaError('%r is not a path, %r is at %r' %
+                          (target, names[-1], '/'.join(path[1:])))
+
+    return path
+
+
+class SourceReader(object):
+    """
+    File wrapper used by the stream loader. YAML parser reads decoded text
+    from it, while byte offset of each chunk is remembered, so scalars can
+    be read back from the file later by their character position.
+    """
+
+    def __init__(self, fn):
+        self.name = fn
+        self.stream = open(fn, 'rb')
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.chars = 0
+        self.bytes = 0
+        self.chunk_chars = array.array('q')
+        self.chunk_bytes = array.array('q')
+
+    def read(self, size):
+        """
+        Reads and decodes next chunk of the file.
+
+        :param size: Number of bytes to read.
+        :return: Decoded text.
+        """
+        # bytes of incomplete character from previous chunk come first
+        pending = len(self.decoder.getstate()[0])
+
+        data = self.stream.read(size)
+        self.chunk_chars.append(self.chars)
+        self.chunk_bytes.append(self.bytes - pending)
+        self.bytes += len(data)
+
+        text = self.decoder.decode(data, len(data) == 0)
+        self.chars += len(text)
+
+        if len(data) == 0:
+            self.stream.close()
+
+        return text
+
+    def text(self, start, end):
+        """
+        Reads part of the file between two character positions.
+
+        :param start: Position of the first character.
+        :param end: Position after the last character.
+        :return: Text.
+        """
+        i = bisect.bisect_right(self.chunk_chars, start) - 1
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        skip = start - self.chunk_chars[i]
+        text = ''
+
+        with open(self.name, 'rb') as stream:
+            stream.seek(self.chunk_bytes[i])
+
+            while len(text) < end - self.chunk_chars[i]:
+                data = stream.read(65536)
+                text += decoder.decode(data, len(data) == 0)
+                if len(data) == 0:
+                    break
+
+        return text[skip:end - self.chunk_chars[i]]
+
+
+class LazyText(object):
+    """
+    Large scalar that stays in the definition file until it's needed. Hash
+    of the text is kept, so page digests still notice when it changes.
+    """
+    __slots__ = ('source', 'start', 'end', 'digest')
+
+    def __init__(self, source, start, end, digest):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.digest = digest
+
+    def __repr__(self):
+        return 'LazyText(%d)' % self.digest
+
+    def load(self):
+        """
+        Reads and parses the scalar.
+
+        :return: String.
+        """
+        t0 = PROFILER.start()
+        value = yaml.safe_load(self.source.text(self.start, self.end))
+        PROFILER.record('lazy text', t0)
+
+        return '' if value is None else str(value)
+
+
+class Blob(object):
+    """
+    Large text value stored out of line in a file named by SHA-256 of its
+    content. File is memory-mapped when the value is needed, preview for
+    the page is read from the beginning of the file only.
+    """
+    __slots__ = ('path', 'digest')
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+
+    def __repr__(self):
+        return 'Blob(%r)' % self.digest
+
+    def map(self):
+        """
+        Memory-maps the file.
+
+        :return: mmap object, None if file is empty.
+        """
+        with open(self.path, 'rb') as stream:
+            if os.fstat(stream.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self):
+        """
+        Reads the whole value.
+
+        :return: String.
+        """
+        t0 = PROFILER.start()
+        data = self.map()
+
+        if data is None:
+            return ''
+
+        try:
+            text = data[:].decode('utf-8')
+        finally:
+            data.close()
+
+        PROFILER.record('blob', t0)
+
+        return text
+
+    def preview(self):
+        """
+        Reads first two lines of the value.
+
+        :return: Tuple of first two lines and flag telling there's more.
+        """
+        data = self.map()
+
+        if data is None:
+            return [''], False
+
+        try:
+            end = 0
+            for i in range(3):
+                end = data.find(b'\n', end) + 1
+                if end == 0:
+                    end = len(data)
+                    break
+
+            lines = data[:end].decode('utf-8', 'replace').rstrip()
+            lines = lines.split('\n', 2)
+            more = len(lines) > 2 or \
+                re.compile(rb'\S').search(data, end) is not None
+        finally:
+            data.close()
+
+        return lines[0:2], more
+
+
+def blob_dir(fn):
+    """
+    Returns directory of blobs that belongs to given definition.
+
+    :param fn: Filename of input file.
+    :return: Path of the directory.
+    """
+    data = data_filename(fn)
+
+    if data.endswith('_data.yaml'):
+        return data[:-len('_data.yaml')] + '_blobs'
+    return data + '.blobs'
+
+
+def store_blob(dirname, text):
+    """
+    Stores text into content-addressed file, file that already exists is
+    not written again.
+
+    :param dirname: Directory of blobs.
+    :param text: String.
+    :return: SHA-256 of the text.
+    """
+    data = text.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(dirname, digest)
+
+    if not os.path.isfile(path):
+        os.makedirs(dirname, exist_ok=True)
+
+        # write under temporary name, so partial blob is never seen
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as stream:
+            stream.write(data)
+        os.replace(tmp, path)
+
+    return digest
+
+
+def text_preview(elem):
+    """
+    Returns first two lines of textarea value, kept until value changes.
+
+    :param elem: Element object.
+    :return: Tuple of first two lines and flag telling there's more.
+    """
+    if elem.source is not None and shown_value(elem) is SOURCE_LOADING:
+        return [SOURCE_LOADING], False
+
+    value = elem.raw
+
+    if elem.preview is None or elem.preview[0] is not value:
+        if value.__class__ is Blob:
+            lines, more = value.preview()
+        else:
+            lines = elem.value.rstrip().split('\n', 2)
+            more = len(lines) > 2
+            lines = lines[0:2]
+
+        elem.preview = (elem.raw, lines, more)
+
+    return elem.preview[1], elem.preview[2]
+
+
+class StreamLoader(object):
+    """
+    Builds Tree directly from YAML parser events, so the whole definition
+    is never held as nested lists and dicts. Menus are built as they are
+    parsed, only a single page exists as dict until it's compiled.
+    """
+
+    def __init__(self, fn):
+        self.source = SourceReader(fn)
+        self.loader = yaml.SafeLoader(self.source)
+
+    def next(self):
+        """
+        Returns next parser event.
+
+        :return: Event object.
+        """
+        return self.loader.get_event()
+
+    def scalar(self, event, lazy=False):
+        """
+        Constructs Python value of a scalar.
+
+        :param event: ScalarEvent object.
+        :param lazy: Large strings may be left in the file.
+        :return: Python value or LazyText object.
+        """
+        if isinstance(event, yaml.AliasEvent):
+            raise SchemaError('line %d: aliases are not supported by stream '
+                              'loader' % (event.start_mark.line + 1))
+
+        if not isinstance(event, yaml.ScalarEvent):
+            raise SchemaError('line %d: scalar expected' %
+                              (event.start_mark.line + 1))
+
+        tag = event.tag
+
+        if tag is None or tag == '!':
+            tag = self.loader.resolve(yaml.ScalarNode, event.value,
+                                      event.implicit)
+
+        if lazy and tag == 'tag:yaml.org,2002:str' and \
+                len(event.value) >= LAZY_TEXT_SIZE:
+            return LazyText(self.source, event.start_mark.index,
+                            event.end_mark.index, hash(event.value))
+
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, event.style)
+        constructor = self.loader.yaml_constructors.get(tag)
+
+        if constructor is None:
+            constructor = self.loader.yaml_constructors[None]
+
+        return constructor(self.loader, node)
+
+    def value(self, event, lazy=False):
+        """
+        Constructs Python object (scalar, list or dict) from events.
+
+        :param event: First event of the object.
+        :param lazy: Large strings may be left in the file.
+        :return: Python object.
+        """
+        if isinstance(event, yaml.SequenceStartEvent):
+            result = []
+            event = self.next()
+
+            while not isinstance(event, yaml.SequenceEndEvent):
+                result.append(self.value(event))
+                event = self.next()
+
+            return result
+
+        if isinstance(event, yaml.MappingStartEvent):
+            result = {}
+            event = self.next()
+
+            while not isinstance(event, yaml.MappingEndEvent):
+                key = self.scalar(event)
+                result[key] = self.value(self.next(), key == 'value')
+                event = self.next()
+
+            return result
+
+        return self.scalar(event, lazy)
+
+    def load(self, old=None, digests=False):
+        """
+        Parses the file and compiles it.
+
+        :param old: Previously compiled Tree object or None.
+        :param digests: Keep digest of each page.
+        :return: Tree object.
+        """
+        event = self.next()
+
+        while not isinstance(event, yaml.MappingStartEvent):
+            if isinstance(event, (yaml.StreamEndEvent,
+                                  yaml.SequenceStartEvent,
+                                  yaml.ScalarEvent)):
+                raise SchemaError('top level object has to be a menu')
+            event = self.next()
+
+        tree = Tree()
+        tree.loader = 'stream'
+        tree.blobs = blob_dir(self.source.name)
+
+        # user edits are kept across reloads
+        if old is not None:
+            tree.overlay = old.overlay
+
+        header = {}
+        tree.root = self.node(tree, 'top level', old, digests, header)
+        tree.commands = header.get('commands')
+        tree.overlay.prune(tree)
+        compile_depends(tree)
+
+        return tree
+
+    def node(self, tree, where, old, digests, header=None):
+        """
+        Builds menu or page from events following MappingStartEvent.
+        Content of a menu is built right away if menu ID comes before it,
+        otherwise the whole node is compiled from dict.
+
+        :param tree: Tree object being built.
+        :param where: Location of the object, used in error messages.
+        :param old: Previously compiled Tree object or None.
+        :param digests: Keep digest of each page.
+        :param header: Dict for keys of the node, other than content.
+        :return: Menu or Page object.
+        """
+        if header is None:
+            header = {}
+
+        menu = None
+        event = self.next()
+
+        while not isinstance(event, yaml.MappingEndEvent):
+            key = self.scalar(event)
+            event = self.next()
+
+            if key == 'content' and MENU in header and menu is None:
+                nid = header[MENU]
+                check_id(tree, nid, where)
+                where = '%s %r' % (MENU, nid)
+
+                menu = Menu(intern_str(nid), None)
+                tree.nodes[menu.nid] = menu
+
+                if not isinstance(event, yaml.SequenceStartEvent):
+                    raise SchemaError('%s: content has to be non-empty list'
+                                      % where)
+
+                event = self.next()
+
+                while not isinstance(event, yaml.SequenceEndEvent):
+                    if not isinstance(event, yaml.MappingStartEvent):
+                        raise SchemaError('content[%d] of %s: menu or page '
+                                          'expected' %
+                                          (len(menu.content), where))
+
+                    child = self.node(
+                        tree, 'content[%d] of %s' % (len(menu.content), where),
+                        old, digests)
+                    tree.parents[child.nid] = menu.nid
+                    menu.content.append(child)
+                    event = self.next()
+
+                if len(menu.content) == 0:
+                    raise SchemaError('%s: content has to be non-empty list'
+                                      % where)
+            else:
+                header[key] = self.value(event, key == 'value')
+
+            event = self.next()
+
+        if menu is None:
+            return compile_node(tree, header, where, old, digests)
+
+        if header.get('title') is None:
+            raise SchemaError('%s: missing title' % where)
+
+        menu.title = intern_str(str(header['title']))
+        menu.depends = header.get('depends_on')
+
+        return menu
+
+
+def intern_str(value):
+    """
+    Interns strings, so repeated IDs and titles are stored only once.
+
+    :param value: Any value.
+    :return: Interned string or value as it was.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def load_tree(fn, loader='dict', old=None, digests=False):
+    """
+    Opens file with YAML definition and compiles it.
+
+    :param fn: Filename of input file.
+    :param loader: 'dict' loads whole file with PyYAML first, 'stream'
+                   builds the tree from parser events.
+    :param old: Previously compiled Tree object or None.
+    :param digests: Keep digest of each page.
+    :return: Tree object.
+    """
+    if loader == 'dict':
+        tree = compile_tree(open_yaml(fn), old, digests, blob_dir(fn))
+    else:
+        t0 = PROFILER.start()
+        tree = StreamLoader(fn).load(old, digests or old is not None)
+        PROFILER.record('open_yaml_stream', t0)
+
+    tree.loader = loader
+
+    return tree
+
+
+def scan_root(fn):
+    """
+    Reads only root menu and its items from the definition with libyaml
+    parser, so the root menu can be shown before the definition is loaded.
+    Parsing stops once root content, menu ID and title are read. Items are
+    Menu and Page objects without content. Nothing is returned
+    when the scan could show something the loaded definition would not,
+    e.g. an item with depends_on, or when libyaml is not available.
+
+    :param fn: Filename of input file.
+    :return: Menu object or None.
+    """
+    loader = getattr(yaml, 'CSafeLoader', None)
+
+    if loader is None:
+        return None
+
+    t0 = PROFILER.start()
+    resolver = yaml.resolver.Resolver()
+    root = {}
+    items = []
+
+    # open collections, each as [is mapping, what it fills (root dict, dict
+    # of root content item, 'content' for root content or None), its key]
+    stack = []
+    scanned = False
+
+    try:
+        with open(fn, 'rb') as stream:
+            for event in yaml.parse(stream, Loader=loader):
+
+                # rest of the file doesn't change what root menu shows
+                if scanned and MENU in root and 'title' in root:
+                    break
+
+                kind = event.__class__
+
+                if kind is yaml.ScalarEvent:
+                    collection = False
+                elif kind is yaml.MappingStartEvent or \
+                        kind is yaml.SequenceStartEvent:
+                    collection = True
+                elif kind is yaml.MappingEndEvent or \
+                        kind is yaml.SequenceEndEvent:
+                    if stack.pop()[1] == 'content':
+                        scanned = True
+                    continue
+                elif kind is yaml.AliasEvent:
+                    return None
+                else:
+                    continue
+
+                parent = stack[-1] if len(stack) > 0 else None
+
+                if parent is not None and parent[1] == 'content':
+                    # root content has to be a list of menus and pages
+                    if kind is not yaml.MappingStartEvent:
+                        return None
+                    items.append({})
+                    stack.append([True, items[-1], None])
+                    continue
+
+                if parent is None:
+                    target = root if collection else None
+                elif parent[2] is None:
+                    if not collection and parent[0]:
+                        parent[2] = event.value
+                    target = None
+                else:
+                    key = parent[2]
+                    parent[2] = None
+                    target = None
+
+                    if parent[1] is root and key == 'content':
+                        if kind is not yaml.SequenceStartEvent:
+                            return None
+                        target = 'content'
+                    elif isinstance(parent[1], dict) and not collection:
+                        # only plain strings, others need a constructor
+                        tag = event.tag
+                        if tag is None or tag == '!':
+                            tag = resolver.resolve(yaml.ScalarNode,
+                                                   event.value,
+                                                   event.implicit)
+                        if tag != 'tag:yaml.org,2002:str' and \
+                                key in (MENU, PAGE, 'title'):
+                            return None
+                        parent[1][key] = event.value
+                    elif isinstance(parent[1], dict):
+                        parent[1][key] = None
+
+                if kind is yaml.MappingStartEvent:
+                    stack.append([True, target, None])
+                elif collection:
+                    stack.append([False, target, None])
+    except (yaml.YAMLError, OSError):
+        return None
+
+    PROFILER.record('scan_root', t0)
+
+    if MENU not in root or 'title' not in root or 'depends_on' in root or \
+            len(items) == 0:
+        return None
+
+    menu = Menu(intern_str(root[MENU]), intern_str(root['title']))
+
+    for item in items:
+        if (MENU in item) == (PAGE in item) or 'title' not in item or \
+                'depends_on' in item:
+            return None
+
+        if MENU in item:
+            node = Menu(intern_str(item[MENU]), intern_str(item['title']))
+        else:
+            node = Page(intern_str(item[PAGE]), intern_str(item['title']),
+                        None)
+
+        menu.content.append(node)
+
+    return menu
+
+
+def bench_load(fn):
+    """
+    Loads definition with each loader and prints time and peak memory.
+    Time of the scan of root menu tells how soon the UI can show it.
+
+    :param fn: Filename of input file.
+    :return: None.
+    """
+    t0 = time.perf_counter()
+    menu = scan_root(fn)
+    elapsed = time.perf_counter() - t0
+
+    if menu is None:
+        print('root menu can be shown only once definition is loaded')
+    else:
+        print('scan   root %8.3f s  (%d items)' %
+              (elapsed, len(menu.content)))
+
+    for loader in ('dict', 'stream'):
+        gc.collect()
+        tracemalloc.start()
+
+        t0 = time.perf_counter()
+        tree = load_tree(fn, loader)
+        elapsed = time.perf_counter() - t0
+
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('%-6s load %8.3f s  peak %9.1f MB  retained %9.1f MB  '
+              '(%d nodes, %d elements)' % (loader, elapsed, peak / 1048576.0,
+                                           current / 1048576.0,
+                                           len(tree.nodes),
+                                           len(tree.elements)))
+        del tree
+
+
+def init_curses():
+    """
+    This function sets up basic curses environment.
+
+    :return: Screen object.
+    """
+    stdscr = curses.initscr()
+
+    maxy, maxx = stdscr.getmaxyx()
+
+    if maxy < 24 or maxx < 80:
+        print("Sorry, but at least 80x24 is needed.")
+        clean_curses()
+        quit(1)
+
+    # colors are not used at all in low bandwidth mode
+    if not LOW_BANDWIDTH:
+        curses.start_color()
+        curses.use_default_colors()
+
+        curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
+        curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
+        curses.init_pair(3, curses.COLOR_BLUE, curses.COLOR_BLACK)
+        curses.init_pair(4, curses.COLOR_RED, curses.COLOR_BLACK)
+        curses.init_pair(5, curses.COLOR_YELLOW, curses.COLOR_BLACK)
+        curses.init_pair(6, curses.COLOR_RED, curses.COLOR_WHITE)
+        curses.init_pair(7, curses.COLOR_MAGENTA, curses.COLOR_BLACK)
+
+    curses.noecho()
+    curses.cbreak()
+    curses.curs_set(0)
+    curses.mousemask(1)
+
+    stdscr.clear()
+    draw_border(stdscr, False)
+    stdscr.refresh()
+    stdscr.keypad(1)
+
+    return stdscr
+
+
+def clean_curses():
+    """
+    Cleans up curses after quit.
+
+    :return: None.
+    """
+    curses.curs_set(1)
+    curses.nocbreak()
+    curses.endwin()
+
+
+def draw_background(screen):
+    """
+    Draws main screen border and help line.
+
+    :param screen: Curses screen object.
+    :return: None.
+    """
+    # clear() makes the terminal repaint everything
+    if LOW_BANDWIDTH:
+        screen.erase()
+    else:
+        screen.clear()
+
+    draw_border(screen, False)
+    screen.addstr(0, 2, 'ENTER/SPACE: Enter/edit | ESC: Exit | R: Run | '
+                        'V: Validate all | Q: Quit ', color(1))
+    screen.refresh()
+
+
+def draw_border(win, bold=True):
+    """
+    Draws border of a window, there are none in low bandwidth mode.
+
+    :param win: Curses window object.
+    :param bold: Draw it bold.
+    :return: None.
+    """
+    if LOW_BANDWIDTH:
+        return
+
+    if bold:
+        win.attron(curses.A_BOLD)
+        win.border()
+        win.attroff(curses.A_BOLD)
+    else:
+        win.border()
+
+
+def color(pair):
+    """
+    Returns attribute of a color pair, plain text in low bandwidth mode.
+
+    :param pair: Color pair number.
+    :return: Curses attribute.
+    """
+    if LOW_BANDWIDTH:
+        return 0
+
+    return curses.color_pair(pair)
+
+
+def draw_marker(win, y, selected):
+    """
+    Marks selected row of menu or page in low bandwidth mode, where it
+    isn't highlighted, so moving the cursor changes only two cells.
+
+    :param win: Curses window object.
+    :param y: Row.
+    :param selected: Whether the row is selected.
+    :return: None.
+    """
+    if LOW_BANDWIDTH:
+        win.addstr(y, 0, '>' if selected else ' ')
+
+
+def char_width(char):
+    """
+    Returns number of terminal cells a character takes. Wide East Asian
+    characters take two, combining marks and other zero width characters
+    none.
+
+    :param char: Single character string.
+    :return: 0, 1 or 2.
+    """
+    if unicodedata.combining(char) or \
+            unicodedata.category(char) in ('Mn', 'Me', 'Cf'):
+        return 0
+
+    if unicodedata.east_asian_width(char) in ('W', 'F'):
+        return 2
+
+    return 1
+
+
+@functools.lru_cache(maxsize=8192)
+def wide_text_width(text):
+    """
+    Sums widths of characters of a non-ASCII string. Results are cached,
+    titles are measured again on every frame.
+
+    :param text: String.
+    :return: Number of terminal cells.
+    """
+    return sum(map(char_width, text))
+
+
+def text_width(text):
+    """
+    Returns number of terminal cells the text takes.
+
+    :param text: String.
+    :return: Number of terminal cells.
+    """
+    if text.isascii():
+        return len(text)
+
+    return wide_text_width(text)
+
+
+def truncate_width(text, width):
+    """
+    Returns longest beginning of text that fits into given number of
+    terminal cells. Combining marks stay with their character.
+
+    :param text: String.
+    :param width: Number of terminal cells.
+    :return: String.
+    """
+    if text.isascii():
+        return text[0:max(0, width)]
+
+    if wide_text_width(text) <= width:
+        return text
+
+    used = 0
+
+    for i, char in enumerate(text):
+        used += char_width(char)
+
+        if used > width:
+            return text[0:i]
+
+    return text
+
+
+def pad_width(text, width):
+    """
+    Pads text with spaces to given number of terminal cells.
+
+    :param text: String.
+    :param width: Number of terminal cells.
+    :return: String.
+    """
+    return text + ' ' * (width - text_width(text))
+
+
+def wrap_width(text, width, drop_whitespace=True):
+    """
+    Wraps text into lines of given number of terminal cells, it's
+    textwrap.wrap() that counts wide characters twice and combining marks
+    not at all.
+
+    :param text: String.
+    :param width: Number of terminal cells.
+    :param drop_whitespace: Drop whitespace at the beginning and end of
+                            lines, as textwrap does.
+    :return: List of lines.
+    """
+    if text.isascii():
+        return textwrap.wrap(text, width, drop_whitespace=drop_whitespace)
+
+    text = re.sub(r'\s', ' ', text.expandtabs())
+    lines = []
+    line = []
+    used = 0
+
+    for chunk in re.findall(r' +|[^ ]+', text):
+        size = text_width(chunk)
+
+        # words that fit a line are moved to the next one as a whole
+        if used + size > width and used > 0 and \
+                (chunk[0] == ' ' or size <= width):
+            lines.append(line)
+            line = []
+            used = 0
+
+        if chunk[0] == ' ' and used == 0 and len(lines) > 0 and \
+                drop_whitespace:
+            continue
+
+        # longer words are split wherever the line ends
+        while used + size > width:
+            head = truncate_width(chunk, width - used)
+
+            if len(head) == 0 and used == 0:
+                head = chunk[0]
+
+            line.append(head)
+            lines.append(line)
+            line = []
+            used = 0
+            chunk = chunk[len(head):]
+            size = text_width(chunk)
+
+        line.append(chunk)
+        used += size
+
+    lines.append(line)
+    lines = [''.join(line) for line in lines]
+
+    if drop_whitespace:
+        lines = [line.rstrip(' ') for line in lines]
+        lines = [line for line in lines if len(line) > 0]
+
+    return lines
+
+
+def layout_menu(screen, count, width, mtitle):
+    """
+    Calculates menu size and position for current terminal size and creates
+    its window.
+
+    :param screen: Curses screen object.
+    :param count: Number of menu items.
+    :param width: Width needed to fit menu content and title.
+    :param mtitle: Title of the menu.
+    :return: Tuple of window, its height and width.
+    """
+    maxy, maxx = screen.getmaxyx()
+
+    draw_background(screen)
+
+    # calculate minimal menu height
+    if count < maxy - 4:
+        size_y = count + 2
+    else:
+        size_y = maxy - 4
+
+    # some titles are too large
+    size_x = min(width, maxx - 4)
+
+    # trim title if too long to fit
+    if text_width(mtitle) > size_x - 2:
+        mtitle = truncate_width(mtitle, size_x - 2)
+
+    # calculate position, so the menu is centered
+    pos_y = int(maxy / 2 - size_y / 2)
+    pos_x = int(maxx / 2 - size_x / 2)
+
+    # create actual window and border
+    win = curses.newwin(size_y, size_x, pos_y, pos_x)
+    draw_border(win)
+
+    # draw title
+    win.addstr(0, int(size_x / 2 - text_width(mtitle) / 2), mtitle)
+
+    return win, size_y, size_x
+
+
+def ui_outdated(tree, page=None):
+    """
+    Tells whether menu or page has to be drawn again when getch() times
+    out, otherwise keys are simply read again. That's when the definition
+    finished loading or changed on disk, or when source commands of the
+    page finished.
+
+    :param tree: Compiled definition (Tree object), None during startup.
+    :param page: Page object or None for menu.
+    :return: True or False.
+    """
+    if STARTUP is not None and STARTUP.done():
+        return True
+
+    if WATCHER is not None and tree is not None and WATCHER.pending():
+        return True
+
+    if page is None:
+        return False
+
+    # polling stops once everything finished, even with the same outputs
+    if INPUT_TIMEOUT == SOURCE_POLL and not SOURCES.pending():
+        return True
+
+    return any(SOURCES.cached(elem.source.command) != elem.source.output
+               for elem in page.sources)
+
+
+def draw_menu(screen, tree, menu, msel):
+    """
+    This function draws a menu with given title and handles the keyboard input.
+
+    :param screen: Screen object.
+    :param tree: Compiled definition (Tree object), None while root menu
+                 from scan_root() is shown during startup.
+    :param menu: Currently active Menu object.
+    :param msel: Starting position of cursor in menu.
+    :return: Index of selected item.
+    """
+    # minimal menu width to fit content and title is kept with the menu
+    menu_ids, menu_titles = get_menulist(menu)
+    count = len(menu_ids)
+    win = None
+    top = 0
+
+    # some items might have been hidden meanwhile
+    msel = max(min(msel, count - 1), 0)
+
+    # main loop that handles keyboard input and redrawing
+    while True:
+
+        # (re)create window if it's needed
+        if win is None:
+            t0 = PROFILER.start()
+            win, size_y, size_x = layout_menu(screen, count, menu.width,
+                                              menu.title)
+            rows = menu_rows(menu, size_x - 2)
+            PROFILER.stop('layout', t0)
+
+        t0 = PROFILER.start()
+
+        # scroll only as much as needed to keep cursor visible
+        if msel < top:
+            top = msel
+        elif msel > top + size_y - 3:
+            top = msel - size_y + 3
+
+        lpos = offset = top
+
+        # print the menu content
+        for i in range(1, size_y - 1):
+            mitem = rows[lpos]
+
+            if mitem is None:
+                mitem = menu_titles[lpos]
+
+                if text_width(mitem) > size_x - 2:
+                    mitem = truncate_width(mitem, size_x - 5) + "..."
+
+                mitem = pad_width(mitem, size_x - 2)
+
+                rows[lpos] = mitem
+
+            if msel + 1 == i + offset:
+                win.addstr(i, 1, mitem, color(1))
+            else:
+                win.addstr(i, 1, mitem)
+
+            draw_marker(win, i, msel + 1 == i + offset)
+
+            lpos += 1
+
+        win.refresh()
+        PROFILER.stop('draw', t0)
+        PROFILER.milestone('startup first frame')
+
+        keys = read_keys(screen)
+
+        # getch() timed out, rows are drawn again only if something changed
+        while keys == [-1] and not ui_outdated(tree):
+            keys = read_keys(screen)
+
+        # read keys and redraw, return item index on ENTER, return -1 on exit
+        for ckey in keys:
+
+            # root menu shown during startup, the rest is needed now
+            if tree is None and ckey in (curses.KEY_ENTER, 10, ord(" "),
+                                         ord("R"), ord("r"), ord("V"),
+                                         ord("v")):
+                unget_key(ckey)
+                raise Loaded(msel)
+
+            if ckey == curses.KEY_UP:
+                if msel > 0:
+                    msel -= 1
+            elif ckey == curses.KEY_DOWN:
+                if msel < count - 1:
+                    msel += 1
+            elif ckey == curses.KEY_PPAGE:
+                msel = max(msel - (size_y - 2), 0)
+            elif ckey == curses.KEY_NPAGE:
+                msel = min(msel + size_y - 2, count - 1)
+            elif ckey == curses.KEY_HOME:
+                msel = 0
+            elif ckey == curses.KEY_END:
+                msel = count - 1
+            elif ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
+                if count == 0:
+                    continue
+                del win
+                return msel
+            elif ckey == ord("R") or ckey == ord("r"):
+                run_commands(tree)
+                win = None
+            elif ckey == ord("V") or ckey == ord("v"):
+                raise ValidateAll(msel)
+            elif ckey == ord("q") or ckey == ord("Q"):
+                clean_curses()
+                quit(0)
+            elif ckey == 27 or ckey == curses.KEY_BACKSPACE:
+                return -1
+            elif ckey == curses.KEY_RESIZE:
+                win = None
+            elif ckey == -1 and STARTUP is not None and STARTUP.done():
+                raise Loaded(msel)
+            elif ckey == -1 and WATCHER is not None and tree is not None \
+                    and WATCHER.pending():
+                raise Reload(msel)
+
+    win.refresh()
+
+    del win
+    screen.touchwin()
+    screen.refresh()
+
+
+# page sizes measured for current terminal size, kept until values change
+PAGE_LAYOUTS = {}
+
+# position and size of the last drawn page window
+PAGE_RECT = None
+
+# first shown row of pages taller than terminal
+PAGE_TOPS = {}
+
+
+def measure_page(obj, ptitle, maxy, maxx):
+    """
+    Calculates size of the page needed to fit all its elements.
+
+    :param obj: List of page elements (Element objects).
+    :param ptitle: Page title.
+    :param maxy: Terminal height.
+    :param maxx: Terminal width.
+    :return: Tuple of page height and width.
+    """
+    # something to begin with, fit at least page title
+    size_y = 2
+    size_x = text_width(ptitle) + 2
+    last = len(obj) - 1
+
+    # determine page height and width
+    for i, elem in enumerate(obj):
+        kind = elem.kind
+
+        if kind == CHECKBOX or kind == RADIO:
+            size_y += 1
+            width = text_width(elem.title) + 6
+        elif kind == TEXTBOX:
+            size_y += 1
+            width = text_width(elem.title) + \
+                text_width(str(shown_value(elem))) + 4
+            if width > maxx:
+                width = maxx
+        elif kind == TEXTAREA:
+            size_y += 2
+            width = int(maxx / 2)
+        elif kind == TEXTDISPLAY:
+            value = shown_value(elem)
+
+            # wrapping is handled here
+            if text_width(value) > int(maxx / 2):
+                width = int(maxx / 2)
+                wrapped = wrap_width(value, int(maxx / 2) - 2)
+
+                # if it's too long, we will truncate it to five lines
+                if len(wrapped) > 4:
+                    size_y += 5
+                else:
+                    size_y += len(wrapped)
+
+            else:
+                # it's only one line
+                width = text_width(value) + 2
+                size_y += 1
+
+        # element or radio group has changed, add blank line
+        if i != last and (obj[i + 1].kind != kind or
+                          obj[i + 1].group is not elem.group):
+            size_y += 1
+
+        # current element requires more space, allocate it
+        if width > size_x:
+            size_x = width
+
+    return size_y, size_x
+
+
+def draw_page(screen, tree, fn, obj, pid, ptitle, msel):
+    """
+    This functions draws page and its content.
+
+    :param screen: Curses screen object.
+    :param tree: Compiled definition (Tree object).
+    :param fn: Filename of input file.
+    :param obj: List of page elements (Element objects).
+    :param pid: Page id.
+    :param ptitle: Page title.
+    :param msel: Currently Highlighted item.
+    :return: Position of currently selected page element.
+    """
+    global PAGE_RECT
+
+    t0 = PROFILER.start()
+
+    maxy, maxx = screen.getmaxyx()
+    last = len(obj) - 1
+
+    # measure page unless it's already measured for this terminal size
+    layout = PAGE_LAYOUTS.get(pid)
+
+    if layout is not None and layout[0] is obj and layout[1] == (maxy, maxx):
+        size_y, size_x = layout[2]
+    else:
+        size_y, size_x = measure_page(obj, ptitle, maxy, maxx)
+        PAGE_LAYOUTS[pid] = (obj, (maxy, maxx), (size_y, size_x))
+
+    # bail out if page doesn't fit even into a pad
+    if size_y > 32767:
+        draw_popup(screen, 'Page is way too large to view.')
+        return -1
+
+    # scroll marks of page taller than terminal need room beside the title
+    if size_y > maxy:
+        size_x = max(size_x, text_width(ptitle) + 18)
+
+    # page would be too wide
+    if size_x > maxx - 4:
+        size_x = maxx - 4
+
+    # page taller than terminal is drawn into a pad scrolled under window
+    # with border, title and help
+    if size_y > maxy:
+        view_y = maxy - 2
+        room = size_x - 6
+    else:
+        view_y = size_y
+        room = size_x
+
+    # calculate position, so the page is centered
+    pos_y = int(maxy / 2 - view_y / 2)
+    pos_x = int(maxx / 2 - size_x / 2)
+
+    PROFILER.stop('layout', t0)
+    t0 = PROFILER.start()
+
+    # smaller page would leave pieces of the old one, so the background is
+    # copied over it again, doupdate() sends only cells that differ
+    rect = (pos_y, pos_x, view_y, size_x)
+
+    if rect != PAGE_RECT:
+        screen.touchwin()
+        screen.noutrefresh()
+        PAGE_RECT = rect
+
+    # create actual window and border
+    win = curses.newwin(view_y, size_x, pos_y, pos_x)
+    draw_border(win)
+
+    if view_y < size_y:
+        canvas = curses.newpad(size_y, size_x)
+    else:
+        canvas = win
+
+    # draw title
+    win.addstr(0, int(size_x / 2 - text_width(ptitle) / 2), ptitle)
+
+    # some help too
+    if room > 60:
+        win.addstr(view_y - 1, 2, 'S: Save | D: Default | A/N/I: All/None/'
+                   'Invert | /: Toggle', color(1))
+    elif room > 22:
+        win.addstr(view_y - 1, 2, 'S: Save | D: Default',
+                   color(1))
+    elif room > 7:
+        win.addstr(view_y - 1, 2, 'S: Save', color(1))
+
+    offset = 1
+    sel_top = sel_bottom = 0
+
+    # main loop that draws page
+    for i, elem in enumerate(obj):
+        kind = elem.kind
+
+        # color for currently selected item
+        if i == msel:
+            cl = color(1)
+        else:
+            cl = color(0)
+
+        draw_marker(canvas, i + offset, i == msel)
+
+        if i == msel:
+            sel_top = i + offset
+
+        # this actually draws what is visible
+        if kind == CHECKBOX:
+            if elem.value is True:
+                canvas.addstr(i + offset, 1, '[*] ' +
+                              truncate_width(elem.title, size_x - 6), cl)
+            else:
+                canvas.addstr(i + offset, 1, '[ ] ' +
+                              truncate_width(elem.title, size_x - 6), cl)
+
+        elif kind == RADIO:
+            if elem.value is True:
+                canvas.addstr(i + offset, 1, '(*) ' +
+                              truncate_width(elem.title, size_x - 6), cl)
+            else:
+                canvas.addstr(i + offset, 1, '( ) ' +
+                              truncate_width(elem.title, size_x - 6), cl)
+
+        elif kind == TEXTBOX:
+            value = str(shown_value(elem))
+
+            # value and title might be too long
+            if text_width(elem.title) + text_width(value) + 4 <= size_x:
+                canvas.addstr(i + offset, 1, elem.title + ": " + value, cl)
+            else:
+                # so truncate it to fit the screen
+                spc = size_x - text_width(elem.title) - 4
+
+                # title is really long, truncate it
+                if spc <= 0:
+                    tmptitle = truncate_width(elem.title,
+                                              int(size_x / 2)) + "..."
+                    spc = size_x - text_width(tmptitle) - 4
+                else:
+                    tmptitle = elem.title
+
+                ln = truncate_width(value, spc)
+                ln = re.sub('...............$', '... [truncated]', ln)
+                canvas.addstr(i + offset, 1, tmptitle + ": " + str(ln), cl)
+
+        elif kind == TEXTAREA:
+
+            # title might be too long
+            tmptitle = truncate_width(elem.title, int(size_x / 2))
+
+            # only first two lines are shown, they are kept with element
+            textlist, more = text_preview(elem)
+
+            # check if there's value at all, otherwise leave space blank
+            if textlist == ['']:
+                canvas.addstr(i + offset, 1, tmptitle + ": ", cl)
+                offset += 1
+            else:
+
+                for j, ln in enumerate(textlist):
+
+                    ln = truncate_width(ln, size_x - 4 -
+                                        text_width(tmptitle))
+
+                    if j == 0:
+                        canvas.addstr(i + offset, 1, tmptitle + ": " + str(ln),
+                                      cl)
+                        offset += 1
+                    if j == 1:
+                        if more:
+                            ln = re.sub('.............$', '... [wrapped]', ln)
+                        canvas.addstr(i + offset, 1 + text_width(tmptitle) + 2,
+                                      str(ln), cl)
+                        break
+
+        elif kind == TEXTDISPLAY:
+
+            # wrapping is handled here
+            textlist = wrap_width(shown_value(elem), size_x - 2)
+
+            # print whatever is in content of textdisplay
+            for j, ln in enumerate(textlist):
+
+                # if it's too many lines, truncate
+                if j == 4 and len(textlist) > 4:
+                    ln = re.sub('.............$', '... [wrapped]', ln)
+                    canvas.addstr(i + offset, 1, str(ln), cl)
+                    break
+
+                # print current line
+                canvas.addstr(i + offset, 1, str(ln), cl)
+
+                if j + 1 < len(textlist):
+                    offset += 1
+
+        if i == msel:
+            sel_bottom = i + offset
+
+        # element or radio group has changed, add blank line
+        if i != last and (obj[i + 1].kind != kind or
+                          obj[i + 1].group is not elem.group):
+            offset += 1
+
+    win.attroff(curses.A_BOLD)
+    win.noutrefresh()
+
+    if canvas is not win:
+        top = PAGE_TOPS.get(pid, 0)
+
+        # scroll only as much as needed to keep cursor visible
+        if sel_bottom > top + view_y - 2:
+            top = sel_bottom - view_y + 2
+        if sel_top < top + 1:
+            top = sel_top - 1
+
+        top = max(0, min(top, size_y - view_y))
+        PAGE_TOPS[pid] = top
+
+        # display arrows, if scrollable
+        up, down = SCROLL_MARKS[LOW_BANDWIDTH]
+
+        if top != 0:
+            win.addstr(0, size_x - 2 - text_width(up), up, color(1))
+        if top + view_y < size_y:
+            win.addstr(view_y - 1, size_x - 2 - text_width(down), down,
+                       color(1))
+
+        win.noutrefresh()
+
+        # border columns of the pad are blank, markers are there without it
+        col = 0 if LOW_BANDWIDTH else 1
+        canvas.noutrefresh(top + 1, col, pos_y + 1, pos_x + col,
+                           pos_y + view_y - 2, pos_x + size_x - 2)
+
+    curses.doupdate()
+
+    PROFILER.stop('draw', t0)
+    PROFILER.milestone('startup first frame')
+
+    keys = read_keys(screen)
+
+    # getch() timed out, page is drawn again only if something changed
+    while keys == [-1] and not ui_outdated(tree, tree.nodes[pid]):
+        keys = read_keys(screen)
+
+    # read keys and update, edit value on ENTER, return -1 if leaving
+    for ckey in keys:
+
+        # all elements might be hidden, there's nothing to select then
+        if len(obj) == 0 and (ckey in BULK_KEYS or
+                              ckey in NAVIGATION_KEYS or
+                              ckey in (curses.KEY_ENTER, 10, ord(" "),
+                                       ord("d"), ord("D"))):
+            continue
+
+        if ckey == curses.KEY_UP:
+            if msel == 0:
+                msel = len(obj) - 1
+            else:
+                msel -= 1
+        elif ckey == curses.KEY_DOWN:
+            if msel == len(obj) - 1:
+                msel = 0
+            else:
+                msel += 1
+        elif ckey == curses.KEY_PPAGE:
+            msel = max(msel - (view_y - 2), 0)
+        elif ckey == curses.KEY_NPAGE:
+            msel = min(msel + view_y - 2, len(obj) - 1)
+        elif ckey == curses.KEY_HOME:
+            msel = 0
+        elif ckey == curses.KEY_END:
+            msel = len(obj) - 1
+        elif ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
+            elem = obj[msel]
+            changed = [elem.eid]
+
+            # selecting radio changes previously selected one too
+            if elem.kind == RADIO and elem.group.selected is not None:
+                changed.append(elem.group.selected.eid)
+
+            set_value(obj, msel, screen)
+            update_visibility(tree, changed)
+
+            # new value of textbox might need wider page
+            if elem.kind == TEXTBOX:
+                PAGE_LAYOUTS.pop(pid, None)
+
+        elif ckey in BULK_KEYS:
+            op, whole = BULK_KEYS[ckey]
+            pattern = None
+
+            if op == 'match':
+                pattern = draw_inputbox(screen, '')
+                if not pattern:
+                    continue
+                op = 'invert'
+
+            if whole:
+                elems = obj
+            else:
+                elems = checkbox_block(obj, msel)
+
+            # one pass, one visibility update and the page is drawn once
+            update_visibility(tree, set_checkboxes(elems, op, pattern))
+
+        elif ckey == ord("d") or ckey == ord("D"):
+            elem = obj[msel]
+
+            # radio buttons are reset with their whole group
+            if elem.group is not None:
+                changed = [member.eid for member in elem.group.members]
+            else:
+                changed = [elem.eid]
+
+            tree.overlay.reset(elem)
+            update_visibility(tree, changed)
+            PAGE_LAYOUTS.pop(pid, None)
+
+        elif ckey == ord("s") or ckey == ord("S"):
+            page = tree.nodes[pid]
+
+            # choices that did not load yet would be missing from saved data
+            if any(elem.source.output is None for elem in page.sources):
+                apply_sources(tree, page, True)
+
+            t0 = PROFILER.start()
+            exval, log = save_yaml(fn, tree, pid, page.content)
+            PROFILER.stop('save', t0)
+
+            # service function might have changed values
+            PAGE_LAYOUTS.pop(pid, None)
+            update_visibility(tree, [elem.eid for elem in page.content])
+
+            # print on_save log if available
+            if len(log) != 0:
+                draw_popup(screen, log)
+
+            # give user some feedback
+            if exval == 0:
+                draw_popup(screen, 'Data saved.')
+            else:
+                draw_popup(screen, 'Save failed.')
+        elif ckey == ord("q") or ckey == ord("Q"):
+            clean_curses()
+            quit(0)
+        elif ckey == 27 or ckey == curses.KEY_BACKSPACE:
+            msel = -1
+
+    # visible elements changed, keep cursor on the same one
+    page = tree.nodes[pid]
+
+    if page.shown is None and msel != -1:
+        shown = shown_content(page)
+
+        if obj[msel] in shown:
+            msel = shown.index(obj[msel])
+        else:
+            msel = max(min(msel, len(shown) - 1), 0)
+
+    del win, canvas
+    return msel
+
+
+class PopupText(object):
+    """
+    Text of a popup rendered into curses pads, scrolling only copies other
+    part of them to the screen. Pads can't be taller than 32767 lines, so
+    text is split into chunks of PAD_LINES lines, each with its own pad
+    rendered when it's shown first time.
+    """
+    __slots__ = ('lines', 'width', 'pads')
+
+    def __init__(self, lines, width):
+        self.lines = lines
+        self.width = width
+        self.pads = {}
+
+    def pad(self, chunk):
+        """
+        Returns pad with given chunk of text, renders it if needed.
+
+        :param chunk: Chunk number.
+        :return: Curses pad object.
+        """
+        pad = self.pads.get(chunk)
+
+        if pad is None:
+            lines = self.lines[chunk * PAD_LINES:(chunk + 1) * PAD_LINES]
+
+            # extra column, so the last line can be written completely
+            pad = curses.newpad(max(1, len(lines)), self.width + 1)
+
+            for i, line in enumerate(lines):
+                pad.addstr(i, 0, line)
+
+            self.pads[chunk] = pad
+            PROFILER.count('popup pad lines', len(lines))
+
+        return pad
+
+    def show(self, start, height, y, x):
+        """
+        Copies lines of text to virtual screen, curses.doupdate() has to be
+        called afterwards.
+
+        :param start: First line to show.
+        :param height: Number of lines to show.
+        :param y: Screen row of the first line.
+        :param x: Screen column of the text.
+        :return: None.
+        """
+        end = min(start + height, len(self.lines))
+
+        while start < end:
+            chunk, row = divmod(start, PAD_LINES)
+            count = min(end - start, PAD_LINES - row)
+            self.pad(chunk).noutrefresh(row, 0, y, x, y + count - 1,
+                                        x + self.width - 1)
+            start += count
+            y += count
+
+
+def draw_popup(screen, text='empty'):
+    """
+    Generic function that draws a popup window in UI. Text is rendered
+    only once, so even very long texts scroll smoothly.
+
+    :param screen: Curses screen object.
+    :param text: Text to be displayed.
+    :return: None.
+    """
+    win = None
+    start_pos = 0
+    closed = False
+
+    while True:
+
+        # (re)create window for current terminal size
+        if win is None:
+            maxy, maxx = screen.getmaxyx()
+
+            # determine window size
+            if text_width(text) > maxx - 2 or '\n' in text:
+
+                # popup needs more than one line, keep line breaks
+                size_x = int(maxx / 1.5) + 2
+                wrapped = [ln for par in text.split('\n')
+                           for ln in wrap_width(par, int(maxx / 1.5)) or
+                           ['']]
+
+                # try some reasonable window heights
+                if len(wrapped) + 2 > int(maxy / 1.5):
+                    size_y = int(maxy / 1.5)
+                else:
+                    size_y = len(wrapped) + 2
+
+            else:
+                # popup fits on one line
+                size_x = text_width(text) + 2
+                size_y = 3
+                wrapped = [text]
+
+            # calculate position, so the popup is centered
+            pos_y = int(maxy / 2 - size_y / 2)
+            pos_x = int(maxx / 2 - size_x / 2)
+
+            # create actual window, text lives in pads
+            win = curses.newwin(size_y, size_x, pos_y, pos_x)
+            content = PopupText(wrapped, size_x - 2)
+            height = size_y - 2
+
+            # keep scroll position within text
+            start_pos = max(0, min(start_pos, len(wrapped) - height))
+
+            win.erase()
+
+        # frame with scroll marks, text is copied over it
+        draw_border(win)
+
+        if size_x >= 80:
+            win.addstr(0, 2,
+                       ' ARROWS/PGUP/PGDN: Scroll | ENTER/SPACE/BACKSPACE/'
+                       'ESC: Exit view | Q: Quit ', color(1))
+
+        # display arrows, if scrollable
+        up, down = SCROLL_MARKS[LOW_BANDWIDTH]
+
+        if start_pos != 0:
+            win.addstr(0, size_x - 2 - text_width(up), up, color(1))
+        elif LOW_BANDWIDTH:
+            win.addstr(0, size_x - 2 - text_width(up), ' ' * len(up))
+
+        if start_pos + height < len(wrapped):
+            win.addstr(size_y - 1, size_x - 2 - text_width(down), down,
+                       color(1))
+        elif LOW_BANDWIDTH:
+            win.addstr(size_y - 1, size_x - 2 - text_width(down),
+                       ' ' * len(down))
+
+        win.noutrefresh()
+        content.show(start_pos, height, pos_y + 1, pos_x + 1)
+        curses.doupdate()
+
+        keys = read_keys(screen)
+
+        # getch() timed out, nothing to redraw
+        while keys == [-1]:
+            keys = read_keys(screen)
+
+        # read keys scroll and redraw, handle exit
+        last = max(0, len(wrapped) - height)
+
+        for ckey in keys:
+            if ckey == curses.KEY_UP:
+                start_pos = max(0, start_pos - 1)
+            if ckey == curses.KEY_DOWN:
+                start_pos = min(last, start_pos + 1)
+            if ckey == curses.KEY_PPAGE:
+                start_pos = max(0, start_pos - height)
+            if ckey == curses.KEY_NPAGE:
+                start_pos = min(last, start_pos + height)
+            if ckey == curses.KEY_HOME:
+                start_pos = 0
+            if ckey == curses.KEY_END:
+                start_pos = last
+            if ckey == curses.KEY_RESIZE:
+                win = None
+            if ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
+                closed = True
+            if ckey == ord("q") or ckey == ord("Q"):
+                clean_curses()
+                quit(0)
+            if ckey == 27 or ckey == curses.KEY_BACKSPACE:
+                closed = True
+
+        if closed:
+            break
+
+    del win
+    screen.touchwin()
+    screen.refresh()
+
+
+class Link(object):
+    """
+    Menu item of validation report that points to a page.
+    """
+    __slots__ = ('kind', 'nid', 'title', 'visible')
+
+    def __init__(self, nid, title):
+        self.kind = PAGE
+        self.nid = nid
+        self.title = title
+        self.visible = True
+
+
+def draw_progress(screen, text):
+    """
+    Shows one line progress window, it's left on screen until something
+    else is drawn.
+
+    :param screen: Curses screen object.
+    :param text: Text to be displayed.
+    :return: None.
+    """
+    maxy, maxx = screen.getmaxyx()
+    text = text[0:maxx - 6]
+
+    win = curses.newwin(3, len(text) + 2, int(maxy / 2 - 1),
+                        int(maxx / 2 - (len(text) + 2) / 2))
+    draw_border(win)
+    win.addstr(1, 1, text)
+    win.refresh()
+
+    del win
+
+
+def draw_validation(screen, tree, fn):
+    """
+    Validates all pages while showing progress, then shows report with
+    pages that failed or logged something. Selecting page in the report
+    shows its problems and opens it.
+
+    :param screen: Curses screen object.
+    :param tree: Compiled definition (Tree object).
+    :param fn: Filename of input file.
+    :return: None.
+    """
+    def progress(done, total, pid):
+        draw_progress(screen, 'Validating %d/%d: %s' % (done, total, pid))
+
+    draw_background(screen)
+    results = validate_tree(tree, progress=progress)
+    failed = len([r for r in results.values() if validation_failed(r)])
+
+    if len(results) == 0:
+        draw_popup(screen, 'All pages are valid.')
+        return
+
+    report = Menu(None, 'Validation: %d pages failed' % failed)
+
+    for pid, result in results.items():
+        if validation_failed(result):
+            state = 'problems: %d' % (len(result[1]) +
+                                      (result[2] is not None))
+        else:
+            state = 'log only'
+        report.content.append(Link(pid, '%s: %s' % (tree.nodes[pid].title,
+                                                    state)))
+
+    msel = 0
+
+    while True:
+        try:
+            msel = draw_menu(screen, tree, report, msel)
+        except (Reload, ValidateAll):
+            # let main loop handle it
+            return
+
+        if msel == -1:
+            return
+
+        pid = report.content[msel].nid
+        page = tree.nodes[pid]
+        draw_popup(screen, format_validation(tree, pid, results[pid]))
+
+        psel = 0
+
+        while psel != -1 and page.visible:
+            content = shown_content(page)
+            psel = max(min(psel, len(content) - 1), 0)
+            psel = draw_page(screen, tree, fn, content, pid, page.title,
+                             psel)
+
+
+def edit_textbox(tpad):
+    """
+    Runs editing loop of curses.textpad.Textbox with keys read by
+    read_key(), so they're profiled, recorded and replayed as all others.
+
+    :param tpad: Textbox object.
+    :return: Edited text.
+    """
+    while True:
+        ckey = read_key(tpad.win)
+
+        if ckey == -1:
+            continue
+
+        if not tpad.do_command(ckey):
+            break
+
+        tpad.win.refresh()
+
+    return tpad.gather()
+
+
+def draw_inputbox(screen, text='empty'):
+    """
+    Generic function that draws a inputbox in UI.
+
+    :param screen: Curses screen object.
+    :param text: Text to be displayed
+    :return: value
+    """
+    maxy, maxx = screen.getmaxyx()
+
+    if len(str(text)) > 64:
+        draw_popup(screen, 'Field contains invalid value.')
+        return None
+
+    # calculate position, so the inputbox is centered
+    size_x = int(67)
+    pos_y = int(maxy / 2 - 2)
+    pos_x = int(maxx / 2 - size_x / 2)
+
+    # create actual window and border
+    win = curses.newwin(3, size_x, pos_y, pos_x)
+    draw_border(win, False)
+    win.addstr(0, 1, 'Please insert value (EMACS keys available):',
+               color(1))
+    win.refresh()
+
+    # derived subwindow
+    swin = win.derwin(1, size_x - 2, 1, 1)
+
+    curses.cbreak()
+    curses.curs_set(1)
+    screen.keypad(1)
+
+    # draw textpad and read value
+    tpad = curses.textpad.Textbox(swin)
+    swin.addstr(0, 0, str(text))
+    value = edit_textbox(tpad)
+
+    curses.curs_set(0)
+
+    del swin
+    del win
+    screen.touchwin()
+    screen.refresh()
+
+    return value.rstrip()
+
+
+def draw_inputarea(screen, text='empty'):
+    """
+    Generic function that draws a 'editor' in UI.
+
+    :param screen: Curses screen object.
+    :param text: Text to be displayed
+    :return: value
+    """
+    maxy, maxx = screen.getmaxyx()
+
+    pos_y = int(4)
+    pos_x = int(4)
+
+    win = curses.newwin(maxy - 8, maxx - 8, pos_y, pos_x)
+    draw_border(win, False)
+    win.refresh()
+
+    swin = win.derwin(maxy - 10, maxx - 10, 1, 1)
+
+    curses.cbreak()
+    curses.curs_set(1)
+    screen.keypad(1)
+
+    win.addstr(0, 1, 'EMACS-like keys available, CTRL-G to exit')
+    win.refresh()
+
+    tpad = curses.textpad.Textbox(swin)
+    swin.addstr(0, 0, str(text))
+    value = edit_textbox(tpad)
+
+    curses.curs_set(0)
+
+    del swin
+    del win
+    screen.touchwin()
+    screen.refresh()
+
+    return value.rstrip()
+
+
+def open_yaml(yfile):
+    """
+    This function opens file with YAML configuration.
+
+    :param yfile: Name of file.
+    :return: Python object ( nested lists / dicts ).
+    """
+    t0 = PROFILER.start()
+
+    with open(yfile, 'r') as stream:
+        yamlobj = yaml.safe_load(stream)
+
+    PROFILER.record('open_yaml', t0)
+
+    return yamlobj
+
+
+def load_service_functions(fn, globs):
+    """
+    This function imports service functions if they are present.
+
+    :param fn: Filename of opened file.
+    :param globs: Caller's globals().
+    :return: 0 if success, else 1.
+    """
+
+    fn = re.sub('.yaml$', '.py', fn)
+
+    if os.path.isfile(fn):
+        exec(compile(open(fn).read(), fn, 'exec'), globs)
+        return 0
+    else:
+        return 1
+
+
+def run_commands(tree):
+    """
+    Runs commands stored in YAML.
+
+    :param tree: Compiled definition (Tree object).
+    :return: None.
+    """
+
+    # reset screen
+    clean_curses()
+
+    # run commands
+    os.system(tree.commands)
+
+    input("Press ENTER to continue ... ")
+
+    # reinit stuff back
+    curses.noecho()
+    curses.cbreak()
+    curses.curs_set(0)
+    curses.mousemask(1)
+
+
+def data_filename(fn):
+    """
+    Makes up name of file with saved values.
+
+    :param fn: Filename of input file.
+    :return: Filename of _data file.
+    """
+    if re.match('^.*\.yaml$', fn):
+        # just so the source is *never* overwritten
+        fn += '_'
+        fn = re.sub('\.yaml_$', '_data.yaml', fn)
+    else:
+        # filename was odd, so we just use something
+        fn += '.data'
+
+    return fn
+
+
+def save_yaml(fn, tree, pid, obj):
+    """
+    This function saves values of a page into storage of saved values,
+    _data.yaml by default. Textarea values longer than BLOB_SIZE are stored
+    as blobs and only referenced from the storage.
+
+    :param fn: Filename of input file.
+    :param tree: Compiled definition (Tree object).
+    :param pid: Page ID.
+    :param obj: List of page elements (Element objects).
+    :return: Exit status.
+    """
+    t0 = PROFILER.start()
+    newobj = {}
+
+    if len(obj) == 0:
+        return 1
+
+    blobs = blob_dir(fn)
+    store = open_store(fn)
+
+    # fetch save function, if available
+    save_func = tree.nodes[pid].on_save
+
+    # save only values/items that we want, blobs are loaded only when
+    # service function needs them
+    for elem in obj:
+        if elem.kind == TEXTDISPLAY:
+            continue
+
+        if elem.raw.__class__ is Blob and save_func not in globals():
+            newobj[elem.eid] = elem.raw
+        else:
+            newobj[elem.eid] = "" if elem.value is None else elem.value
+
+    log = ""
+
+    # if the function is available, call it and pass the dict
+    if save_func in globals():
+        vt0 = PROFILER.start()
+        log = eval(save_func + '(newobj)')
+        PROFILER.record('validator ' + save_func, vt0)
+
+        # reverse mapping back to UI
+        for elem in obj:
+            if elem.eid in newobj:
+                elem.value = newobj[elem.eid]
+
+                # keep radio groups in sync with values
+                if elem.kind == RADIO:
+                    if elem.value is True:
+                        elem.group.selected = elem
+                    elif elem.group.selected is elem:
+                        elem.group.selected = None
+
+    # declarative constraints are checked after service function had a
+    # chance to fix the values
+    problems = check_page(tree.nodes[pid])
+
+    if len(problems) > 0:
+        if len(log) != 0:
+            log += '\n'
+        log += format_problems(tree, problems)
+        PROFILER.record('save_yaml', t0)
+        return 1, log
+
+    # large values go out of line
+    for elem in obj:
+        value = newobj.get(elem.eid)
+
+        if value.__class__ is Blob:
+            newobj[elem.eid] = {'blob': value.digest}
+        elif elem.kind == TEXTAREA and isinstance(value, str) and \
+                len(value) > BLOB_SIZE:
+            newobj[elem.eid] = {'blob': store_blob(blobs, value)}
+
+    # storage decides how much has to be written
+    store.save_page(pid, newobj)
+
+    PROFILER.record('save_yaml', t0)
+
+    return 0, log
+
+
+def shard_dir(fn):
+    """
+    Returns directory of sharded layout of saved values, one file per
+    page and manifest.yaml with their names.
+
+    :param fn: Filename of input file.
+    :return: Path of the directory.
+    """
+    data = data_filename(fn)
+
+    if data.endswith('.yaml'):
+        return data[:-len('.yaml')]
+    return data + '.d'
+
+
+def write_yaml(path, obj):
+    """
+    Writes YAML file under temporary name and renames it, so readers never
+    see it half written.
+
+    :param path: Filename.
+    :param obj: Python object.
+    :return: None.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+
+    with open(tmp, 'w') as wstream:
+        yaml.dump(obj, wstream, default_flow_style=False)
+
+    os.replace(tmp, path)
+
+
+class Store(abc.ABC):
+    """
+    Storage of saved values, pages are saved one by one and all of them
+    are loaded at once. Subclasses implement particular layouts.
+    """
+    layout = None
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    @abc.abstractmethod
+    def exists(self):
+        """
+        Tells whether storage of this layout exists.
+
+        :return: True or False.
+        """
+
+    @abc.abstractmethod
+    def create(self):
+        """
+        Creates empty storage unless it exists.
+
+        :return: None.
+        """
+
+    @abc.abstractmethod
+    def remove(self):
+        """
+        Removes the storage.
+
+        :return: None.
+        """
+
+    @abc.abstractmethod
+    def load_all(self, jobs=None):
+        """
+        Loads saved values of all pages.
+
+        :param jobs: Number of worker threads, if layout can use them.
+        :return: Dictionary of page ID and dictionary of its values.
+        """
+
+    @abc.abstractmethod
+    def save_page(self, pid, values):
+        """
+        Saves values of one page.
+
+        :param pid: Page ID.
+        :param values: Dictionary of element IDs and values.
+        :return: None.
+        """
+
+    def save_all(self, saved):
+        """
+        Saves values of many pages.
+
+        :param saved: Dictionary of page ID and dictionary of its values.
+        :return: None.
+        """
+        for pid, values in saved.items():
+            self.save_page(pid, values)
+
+    def export(self, path):
+        """
+        Writes all saved values into single YAML file, same as _data.yaml.
+
+        :param path: Filename.
+        :return: Number of exported pages.
+        """
+        saved = self.load_all()
+        write_yaml(path, saved)
+        return len(saved)
+
+
+class YamlStore(Store):
+    """
+    All pages in single <name>_data.yaml, saving a page rewrites the file.
+    """
+    layout = 'single'
+
+    def __init__(self, fn):
+        Store.__init__(self, fn)
+        self.path = data_filename(fn)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def create(self):
+        if not self.exists():
+            write_yaml(self.path, {})
+
+    def remove(self):
+        os.remove(self.path)
+
+    def load_all(self, jobs=None):
+        if not self.exists():
+            return {}
+
+        with open(self.path, 'r') as rstream:
+            # save file was empty for some reason
+            return yaml.safe_load(rstream) or {}
+
+    def save_page(self, pid, values):
+        saved = self.load_all()
+        saved[pid] = values
+        write_yaml(self.path, saved)
+
+    def save_all(self, saved):
+        if self.exists():
+            saved = dict(self.load_all(), **saved)
+        write_yaml(self.path, saved)
+
+
+class ShardedStore(Store):
+    """
+    Directory <name>_data with file per page and manifest.yaml that maps
+    page IDs to file names. Saving a page writes only its own file.
+    """
+    layout = 'sharded'
+
+    def __init__(self, fn):
+        Store.__init__(self, fn)
+        self.path = shard_dir(fn)
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def create(self):
+        if not self.exists():
+            os.makedirs(self.path)
+            self.write_manifest({})
+
+    def remove(self):
+        for name in list(self.read_manifest().values()) + ['manifest.yaml']:
+            if os.path.isfile(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+        os.rmdir(self.path)
+
+    def read_manifest(self):
+        """
+        Reads manifest.
 
-    elif ckey == ord("s") or ckey == ord("S"):
-        exval, log = save_yaml(fn, yamlobj, pid, obj)
+        :return: Dictionary of page ID and shard filename.
+        """
+        path = os.path.join(self.path, 'manifest.yaml')
 
-        # print on_save log if available
-        if len(log) != 0:
-            draw_popup(screen, log)
+        if not os.path.isfile(path):
+            return {}
 
-        # give user some feedback
-        if exval == 0:
-            draw_popup(screen, 'Data saved.')
-        else:
-            draw_popup(screen, 'Save failed.')
-    elif ckey == ord("q") or ckey == ord("Q"):
-        clean_curses()
-        quit(0)
-    elif ckey == 27 or ckey == curses.KEY_BACKSPACE:
-        msel = -1
+        with open(path, 'r') as rstream:
+            manifest = yaml.safe_load(rstream) or {}
 
-    del win
-    return msel
+        return manifest.get('pages') or {}
 
+    def write_manifest(self, pages):
+        """
+        Writes manifest.
 
-def draw_popup(screen, text='empty'):
-    """
-    Generic function that draws a popup window in UI.
+        :param pages: Dictionary of page ID and shard filename.
+        :return: None.
+        """
+        write_yaml(os.path.join(self.path, 'manifest.yaml'),
+                   {'version': 1, 'pages': pages})
 
-    :param screen: Curses screen object.
-    :param text: Text to be displayed.
-    :return: None.
-    """
-    maxy, maxx = screen.getmaxyx()
+    def load_all(self, jobs=None):
+        if not self.exists():
+            return {}
 
-    wrapped = []
+        pages = self.read_manifest()
 
-    # determine window size
-    if len(text) > maxx - 2:
+        def load(name):
+            with open(os.path.join(self.path, name), 'r') as rstream:
+                return yaml.safe_load(rstream) or {}
 
-        # popup needs more than one line
-        size_x = int(maxx / 1.5) + 2
-        wrapped = textwrap.wrap(text, int(maxx / 1.5))
+        # shards are independent, read them concurrently
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            return dict(zip(pages, pool.map(load, pages.values())))
 
-        # try some reasonable window heights
-        if len(wrapped) + 2 > int(maxy / 1.5):
-            size_y = int(maxy / 1.5)
-        else:
-            size_y = len(wrapped) + 2
+    def save_page(self, pid, values):
+        pages = self.read_manifest()
+        name = pages.get(pid)
 
-    else:
-        # popup fits on one line
-        size_x = len(text) + 2
-        size_y = 3
+        # manifest changes only when page is saved for the first time
+        if name is None:
+            self.create()
 
-    # calculate position, so the popup is centered
-    pos_y = int(maxy / 2 - size_y / 2)
-    pos_x = int(maxx / 2 - size_x / 2)
+            # page IDs don't have to be usable filenames
+            base = re.sub('[^A-Za-z0-9_.-]', '_', str(pid)).lstrip('.') or \
+                'page'
+            name = base + '.yaml'
+            used = set(pages.values()) | set(['manifest.yaml'])
 
-    # create actual window
-    win = curses.newwin(size_y, size_x, pos_y, pos_x)
+            i = 1
+            while name in used:
+                name = '%s_%d.yaml' % (base, i)
+                i += 1
 
-    start_pos = 0
+            write_yaml(os.path.join(self.path, name), values)
+            pages[pid] = name
+            self.write_manifest(pages)
+        else:
+            write_yaml(os.path.join(self.path, name), values)
 
-    while True:
 
-        # clear and redraw
-        win.clear()
+class SqliteStore(Store):
+    """
+    SQLite database <name>_data.sqlite with row per page element. Values
+    are stored as JSON, so their types are kept.
+    """
+    layout = 'sqlite'
+
+    def __init__(self, fn):
+        Store.__init__(self, fn)
+        self.path = re.sub('\\.yaml$', '', data_filename(fn)) + '.sqlite'
+
+    def connect(self):
+        """
+        Opens the database and creates its schema.
+
+        :return: sqlite3.Connection object.
+        """
+        if sqlite3 is None:
+            raise RuntimeError('Python was built without sqlite3 module')
+
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE IF NOT EXISTS saved ('
+                     'page TEXT NOT NULL, element TEXT NOT NULL, '
+                     'value TEXT, PRIMARY KEY (page, element))')
+        conn.execute('CREATE INDEX IF NOT EXISTS saved_element '
+                     'ON saved (element)')
+
+        return conn
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def create(self):
+        self.connect().close()
+
+    def remove(self):
+        os.remove(self.path)
+
+    def load_all(self, jobs=None):
+        if not self.exists():
+            return {}
+
+        saved = {}
+        conn = self.connect()
+
+        try:
+            for page, element, value in conn.execute(
+                    'SELECT page, element, value FROM saved '
+                    'ORDER BY page, rowid'):
+                saved.setdefault(page, {})[element] = json.loads(value)
+        finally:
+            conn.close()
+
+        return saved
+
+    def load_value(self, pid, eid):
+        """
+        Looks up one saved value.
+
+        :param pid: Page ID.
+        :param eid: Element ID.
+        :return: Value, None if it was not saved.
+        """
+        conn = self.connect()
+
+        try:
+            row = conn.execute('SELECT value FROM saved WHERE page = ? AND '
+                               'element = ?', (pid, eid)).fetchone()
+        finally:
+            conn.close()
+
+        return None if row is None else json.loads(row[0])
+
+    def save_page(self, pid, values):
+        self.save_all({pid: values})
+
+    def save_all(self, saved):
+        conn = self.connect()
+
+        try:
+            # whole save is one transaction
+            with conn:
+                for pid, values in saved.items():
+                    conn.executemany(
+                        'INSERT INTO saved (page, element, value) '
+                        'VALUES (?, ?, ?) ON CONFLICT (page, element) '
+                        'DO UPDATE SET value = excluded.value',
+                        [(pid, eid, json.dumps(value))
+                         for eid, value in values.items()])
+
+                    # elements that are not on the page anymore
+                    stale = [(pid, row[0]) for row in conn.execute(
+                        'SELECT element FROM saved WHERE page = ?', (pid,))
+                        if row[0] not in values]
+                    conn.executemany('DELETE FROM saved WHERE page = ? AND '
+                                     'element = ?', stale)
+        finally:
+            conn.close()
+
+
+# storage layouts of saved values
+STORES = {'single': YamlStore, 'sharded': ShardedStore,
+          'sqlite': SqliteStore}
+
+
+def open_store(fn, layout=None):
+    """
+    Returns storage of saved values. Unless layout is given, database is
+    used if it exists, then directory of shards, then single file.
 
-        # print text into window
-        if len(wrapped) > 0:
-            j = 0
-            for i in range(1, size_y - 1):
-                win.addstr(i, 1, str(wrapped[start_pos + j]))
-                j += 1
-        else:
-            win.addstr(1, 1, str(text))
+    :param fn: Filename of input file.
+    :param layout: 'single', 'sharded', 'sqlite' or None.
+    :return: Store object.
+    """
+    if layout is not None:
+        return STORES[layout](fn)
 
-        win.attron(curses.A_BOLD)
-        win.border()
-        win.attroff(curses.A_BOLD)
+    for cls in (SqliteStore, ShardedStore):
+        store = cls(fn)
+        if store.exists():
+            return store
 
-        if size_x >= 80:
-            win.addstr(0, 2,
-                       ' ARROWS: Up/down | ENTER/SPACE/BACKSPACE/ESC: Exit '
-                       'view | Q: Quit ', curses.color_pair(1))
+    return YamlStore(fn)
 
-        # display arrows, if scrollable
-        if start_pos != 0:
-            win.addstr(0, size_x - 7, '↑↑↑↑↑', curses.color_pair(1))
 
-        if start_pos + size_y - 2 < len(wrapped):
-            win.addstr(size_y - 1, size_x - 7, '↓↓↓↓↓', curses.color_pair(1))
+def convert_data(fn, layout):
+    """
+    Converts saved values to another storage layout, the old layout is
+    removed once the new one is written.
 
-        win.refresh()
-        ckey = screen.getch()
+    :param fn: Filename of input file.
+    :param layout: 'single', 'sharded' or 'sqlite'.
+    :return: Number of converted pages.
+    """
+    source = open_store(fn)
+    saved = source.load_all()
 
-        # read keys scroll and redraw, handle exit
-        if ckey == curses.KEY_UP:
-            if start_pos > 0:
-                start_pos -= 1
-        if ckey == curses.KEY_DOWN:
-            if start_pos + size_y - 2 < len(wrapped):
-                start_pos += 1
-        if ckey == curses.KEY_ENTER or ckey == 10 or ckey == ord(" "):
-            break
-        if ckey == ord("q") or ckey == ord("Q"):
-            clean_curses()
-            quit(0)
-        if ckey == 27 or ckey == curses.KEY_BACKSPACE:
-            break
+    if source.layout == layout:
+        return len(saved)
 
-    del win
-    screen.touchwin()
-    screen.refresh()
+    target = open_store(fn, layout)
+    target.create()
+    target.save_all(saved)
 
+    if source.exists():
+        source.remove()
 
-def draw_inputbox(screen, text='empty'):
-    """
-    Generic function that draws a inputbox in UI.
+    return len(saved)
 
-    :param screen: Curses screen object.
-    :param text: Text to be displayed
-    :return: value
+
+def apply_saved(tree, saved, blobs):
     """
-    maxy, maxx = screen.getmaxyx()
+    Sets values of elements to saved ones. They are treated as edits, so
+    they're kept when definition is reloaded.
 
-    if len(str(text)) > 64:
-        draw_popup(screen, 'Field contains invalid value.')
-        return None
+    :param tree: Tree object.
+    :param saved: Dictionary returned by Store.load_all().
+    :param blobs: Directory of blobs.
+    :return: None.
+    """
+    changed = []
 
-    # calculate position, so the inputbox is centered
-    size_x = int(67)
-    pos_y = int(maxy / 2 - 2)
-    pos_x = int(maxx / 2 - size_x / 2)
+    for pid, values in saved.items():
+        if not isinstance(values, dict):
+            continue
 
-    # create actual window and border
-    win = curses.newwin(3, size_x, pos_y, pos_x)
-    win.border()
-    win.addstr(0, 1, 'Please insert value (EMACS keys available):',
-               curses.color_pair(1))
-    win.refresh()
+        for eid, value in values.items():
+            elem = tree.elements.get(eid)
 
-    # derived subwindow
-    swin = win.derwin(1, size_x - 2, 1, 1)
+            # choice of sourced radio group might appear only later
+            if elem is None and value is True and \
+                    sourced_choice(tree, pid, eid):
+                tree.overlay.set(eid, True, False)
+                continue
 
-    curses.cbreak()
-    curses.curs_set(1)
-    screen.keypad(1)
+            # saved values of pages that changed since might not fit
+            if elem is None or tree.parents.get(eid) != pid:
+                continue
 
-    # draw textpad and read value
-    tpad = curses.textpad.Textbox(swin)
-    swin.addstr(0, 0, str(text))
-    value = tpad.edit()
+            if elem.kind == RADIO:
+                if value is True:
+                    elem.group.select(elem)
+            elif elem.kind == CHECKBOX:
+                elem.value = value is True
+            elif elem.kind == TEXTAREA and isinstance(value, dict) and \
+                    isinstance(value.get('blob'), str):
+                elem.value = Blob(os.path.join(blobs, value['blob']),
+                                  value['blob'])
+            elif elem.kind != TEXTDISPLAY:
+                elem.value = '' if value is None else str(value)
 
-    curses.curs_set(0)
+            changed.append(eid)
 
-    del swin
-    del win
-    screen.touchwin()
-    screen.refresh()
+    update_visibility(tree, changed)
 
-    return value.rstrip()
 
+def sourced_choice(tree, pid, eid):
+    """
+    Tells whether ID belongs to a choice of sourced radio group of a page.
 
-def draw_inputarea(screen, text='empty'):
+    :param tree: Tree object.
+    :param pid: Page ID.
+    :param eid: Element ID.
+    :return: True or False.
     """
-    Generic function that draws a 'editor' in UI.
+    holder = tree.elements.get(eid.rpartition('.')[0])
 
-    :param screen: Curses screen object.
-    :param text: Text to be displayed
-    :return: value
+    return holder is not None and tree.parents.get(holder.eid) == pid and \
+        holder.source is not None and holder.source.group is not None
+
+
+def load_profiles(tree, fn):
     """
-    maxy, maxx = screen.getmaxyx()
+    Loads host profiles and builds layered overlays for them. Profiles file
+    has base values, values of host groups and hosts that might belong to
+    a group, all of them keyed by element ID:
+
+        base: {kernel_log_buffer: 16}
+        groups:
+          web: {sys_v_ipc: true}
+        hosts:
+          web1: {group: web, values: {kernel_log_buffer: 8}}
+
+    Host overlay sits on top of its group which sits on top of base, so
+    values are shared and each layer keeps only what it changes.
+
+    :param tree: Tree object.
+    :param fn: Filename of profiles.
+    :return: Dictionary of host name and its Overlay object.
+    """
+    profiles = open_yaml(fn) or {}
 
-    pos_y = int(4)
-    pos_x = int(4)
+    if not isinstance(profiles, dict):
+        raise SchemaError('%s: profiles have to be a dictionary' % fn)
 
-    win = curses.newwin(maxy - 8, maxx - 8, pos_y, pos_x)
-    win.border()
-    win.refresh()
+    base = profile_overlay(tree, profiles.get('base'), None, 'base')
+    groups = {}
 
-    swin = win.derwin(maxy - 10, maxx - 10, 1, 1)
+    for name, values in (profiles.get('groups') or {}).items():
+        groups[name] = profile_overlay(tree, values, base, 'group %r' % name)
 
-    curses.cbreak()
-    curses.curs_set(1)
-    screen.keypad(1)
+    hosts = {}
 
-    win.addstr(0, 1, 'EMACS-like keys available, CTRL-G to exit')
-    win.refresh()
+    for name, host in (profiles.get('hosts') or {}).items():
+        if not isinstance(host, dict):
+            raise SchemaError('host %r: dictionary expected' % name)
 
-    tpad = curses.textpad.Textbox(swin)
-    swin.addstr(0, 0, str(text))
-    value = tpad.edit()
+        group = host.get('group')
 
-    curses.curs_set(0)
+        if group is not None and group not in groups:
+            raise SchemaError('host %r: unknown group %r' % (name, group))
 
-    del swin
-    del win
-    screen.touchwin()
-    screen.refresh()
+        parent = base if group is None else groups[group]
+        hosts[name] = profile_overlay(tree, host.get('values'), parent,
+                                      'host %r' % name)
 
-    return value.rstrip()
+    return hosts
 
 
-def open_yaml(yfile):
+def profile_overlay(tree, values, parent, where):
     """
-    This function opens file with YAML configuration.
+    Builds one layer of profile.
 
-    :param yfile: Name of file.
-    :return: Python object ( nested lists / dicts ).
+    :param tree: Tree object.
+    :param values: Dictionary of element IDs and values.
+    :param parent: Overlay object of layer below or None.
+    :param where: Name of the layer, used in error messages.
+    :return: Overlay object.
     """
-    with open(yfile, 'r') as stream:
-        yamlobj = yaml.load(stream)
-        return yamlobj
+    overlay = Overlay(parent)
 
+    if values is None:
+        return overlay
 
-def load_service_functions(fn, globs):
-    """
-    This function imports service functions if they are present.
+    if not isinstance(values, dict):
+        raise SchemaError('%s: values have to be a dictionary' % where)
 
-    :param fn: Filename of opened file.
-    :param globs: Caller's globals().
-    :return: 0 if success, else 1.
-    """
+    for eid, value in values.items():
+        elem = tree.elements.get(eid)
 
-    fn = re.sub('.yaml$', '.py', fn)
+        if elem is None or elem.kind == TEXTDISPLAY:
+            raise SchemaError('%s: unknown element %r' % (where, eid))
+
+        if elem.kind == RADIO:
+            if value is True:
+                overlay.select(elem.group, elem)
+        elif elem.kind == CHECKBOX:
+            overlay.set(eid, value is True, elem.default)
+        else:
+            overlay.set(eid, '' if value is None else str(value),
+                        elem.default)
+
+    return overlay
 
-    if os.path.isfile(fn):
-        exec(compile(open(fn).read(), fn, 'exec'), globs)
-        return 0
-    else:
-        return 1
 
+# profiles file and host whose values are layered under user edits
+HOST = None
 
-def run_commands(yamlobj):
+
+def use_host(tree, profiles_fn, host):
     """
-    Runs commands stored in YAML.
+    Puts values of a host profile under user edits.
 
-    :param yamlobj: Python object ( nested list / dicts ).
+    :param tree: Tree object.
+    :param profiles_fn: Filename of profiles.
+    :param host: Host name.
     :return: None.
     """
+    # without the profile if it can't be used
+    tree.overlay.parent = None
 
-    # reset screen
-    clean_curses()
+    try:
+        hosts = load_profiles(tree, profiles_fn)
 
-    # run commands
-    commands = (yamlobj.get('commands'))
-    os.system(commands)
+        if host not in hosts:
+            raise SchemaError('no host %r in %s' % (host, profiles_fn))
 
-    input("Press ENTER to continue ... ")
+        tree.overlay.parent = hosts[host]
+    finally:
+        evaluate_visibility(tree)
 
-    # reinit stuff back
-    curses.noecho()
-    curses.cbreak()
-    curses.curs_set(0)
-    curses.mousemask(1)
+
+# tree and host overlays used by materializing workers
+MATERIALIZE = None
 
 
-def save_yaml(fn, yamlobj, pid, obj):
+def init_materialize(fn, loader, profiles_fn):
     """
-    This function saves values to YAML file.
+    Prepares worker process that did not inherit parsed definition, it's
+    parsed once per worker.
 
     :param fn: Filename of input file.
-    :param yamlobj: Whole Python object ( nested lists / dicts ).
-    :param pid: Page ID.
-    :param obj: Python object ( nested lists / dicts ).
-    :return: Exit status.
+    :param loader: 'dict' or 'stream'.
+    :param profiles_fn: Filename of profiles.
+    :return: None.
     """
-    newobj = {}
+    global MATERIALIZE
 
-    if len(obj) == 0:
-        return 1
+    tree = load_tree(fn, loader)
+    wait_sources(tree)
+    load_service_functions(fn, globals())
+    MATERIALIZE = (tree, load_profiles(tree, profiles_fn))
 
-    # make up new name for _data file
-    if re.match('^.*\.yaml$', fn):
-        # just so the source is *never* overwritten
-        fn += '_'
-        fn = re.sub('\.yaml_$', '_data.yaml', fn)
-    else:
-        # filename was odd, so we just use something
-        fn += '.data'
 
-    # save only values/items that we want
-    for elem in obj:
-        if 'checkbox' in elem:
-            nkey = elem['checkbox']
-            nval = elem.get('value', "")
-            newobj[nkey] = nval
-        elif 'radio' in elem:
-            nkey = elem['radio']
-            nval = elem.get('value', "")
-            newobj[nkey] = nval
-        elif 'textbox' in elem:
-            nkey = elem['textbox']
-            nval = elem.get('value', "")
-            newobj[nkey] = nval
-        elif 'textarea' in elem:
-            nkey = elem['textarea']
-            nval = elem.get('value', "")
-            newobj[nkey] = nval
+def materialize_host(host, outdir):
+    """
+    Computes values of all pages for one host, runs on_save functions and
+    constraints and writes <host>_data.yaml.
 
-    # fetch save function, if available
-    save_func = get_save_function(yamlobj, pid)
+    :param host: Host name.
+    :param outdir: Output directory.
+    :return: Tuple of host name, written filename or None if validation
+             failed and report.
+    """
+    tree, hosts = MATERIALIZE
 
-    log = ""
+    # values of the host become the only layer below (empty) user edits
+    tree.overlay.reset()
+    tree.overlay.parent = hosts[host]
+    evaluate_visibility(tree)
 
-    # if the function is available, call it and pass the dict
-    if save_func in globals():
-        save_func += '(newobj)'
-        log = eval(save_func)
+    saved = {}
+    report = []
 
-        # reverse mapping back to UI
-        for key, val in newobj.items():
-            for elem in obj:
-                if key in elem.values():
-                    elem['value'] = val
+    for node in tree.nodes.values():
+        if node.kind != PAGE:
+            continue
 
-    oldsave = {}
+        saved[node.nid] = page_values(node)
 
-    # if there's old save, load it
-    if os.path.isfile(fn):
-        with open(fn, 'r') as rstream:
-            oldsave = yaml.load(rstream)
+        # hidden pages keep their values, but they aren't validated
+        if not node.visible:
+            continue
 
-            # save file was empty for some reason
-            if oldsave is None:
-                oldsave = {}
+        result = validate_page(tree, node, saved[node.nid])
 
-    oldsave[pid] = newobj
+        if validation_failed(result):
+            report.append('%s: %s' % (node.nid, format_validation(
+                tree, node.nid, result)))
 
-    # save the modified object
-    with open(fn, 'w') as wstream:
-        yaml.dump(oldsave, wstream, default_flow_style=False)
+    if len(report) > 0:
+        return host, None, '\n'.join(report)
 
-    return 0, log
+    path = os.path.join(outdir, '%s_data.yaml' % host)
+    write_yaml(path, saved)
 
+    return host, path, ''
 
-def get_menulist(yamlobj, root=False):
-    """
-    This function parses objects returned by get_menucontent() and prepares
-    input for draw_menu().
 
-    :param yamlobj: Python object ( nested list / dicts ).
-    :param root: True only if parsing YAML hierarchy from top.
-    :return: menu_ids - list of IDs, menu_titles - list of menu titles.
+def materialize_all(fn, loader, profiles_fn, tree, outdir, jobs=None):
     """
-    menu_ids = []
-    menu_titles = []
-
-    if root is True:
-        for obj in yamlobj['content']:
-            if 'menu' in obj:
-                menu_ids.append(obj["menu"])
-                menu_titles.append(obj["title"])
-            elif 'page' in obj:
-                menu_ids.append(obj["page"])
-                menu_titles.append(obj["title"])
-    else:
-        for obj in yamlobj:
-            if 'menu' in obj:
-                menu_ids.append(obj["menu"])
-                menu_titles.append(obj["title"])
-            elif 'page' in obj:
-                menu_ids.append(obj["page"])
-                menu_titles.append(obj["title"])
-
-    return menu_ids, menu_titles
+    Writes _data.yaml of every host in a process pool. Workers inherit the
+    parsed definition, profiles and service functions where processes are
+    forked, elsewhere each worker parses them once.
 
-
-def get_nodetype(obj, objid):
+    :param fn: Filename of input file.
+    :param loader: 'dict' or 'stream'.
+    :param profiles_fn: Filename of profiles.
+    :param tree: Tree object.
+    :param outdir: Output directory.
+    :param jobs: Number of worker processes, None picks default.
+    :return: Number of hosts that failed.
     """
-    Returns key of the object with given ID. (eg., menu, page, etc. )
+    global MATERIALIZE
 
-    :param obj: Structure containing YAML object ( nested lists / dicts ).
-    :param objid: YAML ID of given node.
-    :return: Key of given ID.
-    """
-    result = None
+    hosts = load_profiles(tree, profiles_fn)
+    MATERIALIZE = (tree, hosts)
+    os.makedirs(outdir, exist_ok=True)
 
-    if isinstance(obj, dict):
-        for key, val in obj.items():
-            if val == objid:
-                result = key
-            elif isinstance(val, list) or isinstance(val, dict):
-                retval = get_nodetype(val, objid)
-                if retval is not None:
-                    result = retval
-    elif isinstance(obj, list):
-        for elem in obj:
-            if isinstance(elem, list) or isinstance(elem, dict):
-                retval = get_nodetype(elem, objid)
-                if retval is not None:
-                    result = retval
-    return result
+    if 'fork' in multiprocessing.get_all_start_methods():
+        pool = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context('fork'))
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=init_materialize,
+            initargs=(fn, loader, profiles_fn))
 
+    failed = 0
 
-def get_title(obj, objid):
-    """
-    Returns title value of the object with given ID.
+    with pool:
+        futures = [pool.submit(materialize_host, host, outdir)
+                   for host in hosts]
 
-    :param obj: Structure containing YAML object ( nested lists / dicts ).
-    :param objid: YAML ID of given node.
-    :return: Title of given ID.
-    """
+        for done, future in enumerate(
+                concurrent.futures.as_completed(futures)):
+            host, path, report = future.result()
 
-    result = None
+            if path is None:
+                failed += 1
+                print("[%d/%d] %s FAILED\n%s" % (done + 1, len(hosts), host,
+                                                 report))
+            else:
+                print("[%d/%d] %s -> %s" % (done + 1, len(hosts), host, path))
 
-    if isinstance(obj, dict):
-        for key, val in obj.items():
-            if val == objid:
-                result = obj['title']
-            elif isinstance(val, list) or isinstance(val, dict):
-                retval = get_title(val, objid)
-                if retval is not None:
-                    result = retval
-    elif isinstance(obj, list):
-        for elem in obj:
-            if isinstance(elem, list) or isinstance(elem, dict):
-                retval = get_title(elem, objid)
-                if retval is not None:
-                    result = retval
-    return result
+    return failed
 
 
-def get_save_function(obj, objid):
+def get_menulist(menu):
     """
-    Returns on_save function name the object with given ID.
+    This function prepares input for draw_menu() from content of a menu.
+    Lists are built once and kept in the Menu object.
 
-    :param obj: Structure containing YAML object ( nested lists / dicts ).
-    :param objid: YAML ID of given page.
-    :return: Name of onsave function.
+    :param menu: Menu object.
+    :return: menu_ids - list of IDs, menu_titles - list of menu titles of
+             visible items.
     """
+    if menu.ids is None:
+        shown = [node for node in menu.content if node.visible]
+        menu.ids = [node.nid for node in shown]
+        menu.titles = [node.title for node in shown]
+        menu.rows = None
 
-    result = None
+        # minimal width to fit content and title
+        menu.width = max(max(map(text_width, menu.titles), default=0),
+                         text_width(menu.title)) + 2
 
-    if isinstance(obj, dict):
-        for key, val in obj.items():
-            if val == objid:
-                result = obj.get('on_save')
-            elif isinstance(val, list) or isinstance(val, dict):
-                retval = get_save_function(val, objid)
-                if retval is not None:
-                    result = retval
-    elif isinstance(obj, list):
-        for elem in obj:
-            if isinstance(elem, list) or isinstance(elem, dict):
-                retval = get_save_function(elem, objid)
-                if retval is not None:
-                    result = retval
-    return result
+    return menu.ids, menu.titles
 
 
-def get_objectcontent(obj, objid):
+def menu_rows(menu, width):
     """
-    Returns list / dictionary structure that is content of given YAML ID.
+    Returns list for padded and truncated menu rows of given width. Rows are
+    rendered when they are first shown and kept until width changes.
 
-    :param obj: Structure containing YAML object ( nested lists / dicts ).
-    :param objid: YAML ID of given node.
-    :return: Nested list / dictionary.
+    :param menu: Menu object.
+    :param width: Width of the rows.
+    :return: List of rows, None where row wasn't rendered yet.
     """
-    result = None
+    if menu.rows is None or menu.rows[0] != width:
+        menu.rows = (width, [None] * len(menu.content))
 
-    if isinstance(obj, dict):
-        for key, val in obj.items():
-            if val == objid:
-                result = obj['content']
-            elif isinstance(val, list) or isinstance(val, dict):
-                retval = get_objectcontent(val, objid)
-                if retval is not None:
-                    result = retval
-    elif isinstance(obj, list):
-        for elem in obj:
-            if isinstance(elem, list) or isinstance(elem, dict):
-                retval = get_objectcontent(elem, objid)
-                if retval is not None:
-                    result = retval
-    return result
+    return menu.rows[1]
 
 
 def set_value(obj, msel, screen):
     """
-    Changes value of given YAML object.
+    Changes value of given page element.
 
-    :param obj: Structure containing Python dictionary.
+    :param obj: List of page elements (Element objects).
     :param msel: Object index to modify.
     :param screen: Screen object.
     :return: None.
@@ -897,76 +5275,109 @@ def set_value(obj, msel, screen):
     # editor needs this
     maxy, maxx = screen.getmaxyx()
 
+    elem = obj[msel]
+    kind = elem.kind
+
     # determine what object we try to change and act accordingly
-    if 'checkbox' in obj[msel]:
+    if kind == CHECKBOX:
+        elem.value = elem.value is not True
 
-        if obj[msel].get('value', False) is False:
-            obj[msel]['value'] = True
-        else:
-            obj[msel]['value'] = False
+    elif kind == RADIO:
+        elem.group.select(elem)
 
-    elif 'radio' in obj[msel]:
-        obj[msel]['value'] = True
-        i = msel + 1
+    elif kind == TEXTBOX:
 
-        # disable other adjacent radioboxes
-        while i < len(obj):
-            if 'radio' in obj[i]:
-                obj[i]['value'] = False
-                i += 1
-            else:
-                break
+        # edit current value
+        newval = draw_inputbox(screen, elem.value)
+        elem.value = str(newval)
 
-        i = msel - 1
+    elif kind == TEXTAREA:
 
-        while i >= 0:
-            if 'radio' in obj[i]:
-                obj[i]['value'] = False
-                i -= 1
-            else:
-                break
+        # edit current value
+        elem.value = Editor(screen,
+                            title='Editing ' + elem.title + " ",
+                            inittext=elem.value, box=not LOW_BANDWIDTH,
+                            win_size=(maxy - 6, maxx - 6),
+                            win_location=(3, 3), getch=read_key,
+                            profiler=PROFILER, wrap=wrap_width,
+                            width=text_width, rawgetch=raw_key,
+                            ungetch=unget_key)()
 
-    elif 'textbox' in obj[msel]:
+        # reset to previous state
+        curses.curs_set(0)
+        draw_background(screen)
 
-        # if there's value, edit it
-        if 'value' in obj[msel]:
-            newval = draw_inputbox(screen, obj[msel]['value'])
-            obj[msel]['value'] = str(newval)
-        else:
-            newval = draw_inputbox(screen, '')
-            obj[msel]['value'] = str(newval)
+    elif kind == TEXTDISPLAY:
 
-    elif 'textarea' in obj[msel]:
+        # open scrollable window
+        draw_popup(screen, elem.value)
 
-        # if there's value, edit it
-        if 'value' in obj[msel]:
-            newval = Editor(screen,
-                            title='Editing ' + obj[msel]['title'] + " ",
-                            inittext=obj[msel]['value'], box=True,
-                            win_size=(maxy - 6, maxx - 6),
-                            win_location=(3, 3))()
 
-            obj[msel]['value'] = newval
+def checkbox_block(obj, msel):
+    """
+    Returns block of checkboxes around the cursor, i.e. checkboxes that
+    are drawn together without a blank line between them.
+
+    :param obj: List of page elements (Element objects).
+    :param msel: Index of the element under cursor.
+    :return: List of Element objects, empty if cursor isn't on checkbox.
+    """
+    if obj[msel].kind != CHECKBOX:
+        return []
+
+    start = end = msel
+
+    while start > 0 and obj[start - 1].kind == CHECKBOX:
+        start -= 1
+
+    while end < len(obj) - 1 and obj[end + 1].kind == CHECKBOX:
+        end += 1
+
+    return obj[start:end + 1]
+
+
+def set_checkboxes(elems, op, pattern=None):
+    """
+    Checks, unchecks or inverts many checkboxes in one pass, other
+    elements are skipped.
+
+    :param elems: List of Element objects.
+    :param op: 'all', 'none' or 'invert'.
+    :param pattern: Only checkboxes with title or ID matching this shell
+                    pattern (case insensitive, implicitly *pattern*) are
+                    changed.
+    :return: List of IDs of elements that changed.
+    """
+    if pattern is not None:
+        pattern = '*' + pattern.lower() + '*'
+
+    changed = []
+
+    for elem in elems:
+        if elem.kind != CHECKBOX:
+            continue
+
+        if pattern is not None and \
+                not fnmatch.fnmatchcase(elem.title.lower(), pattern) and \
+                not fnmatch.fnmatchcase(elem.eid.lower(), pattern):
+            continue
+
+        value = elem.value is True
+
+        if op == 'all':
+            new = True
+        elif op == 'none':
+            new = False
         else:
-            newval = Editor(screen,
-                            title='Editing ' + obj[msel]['title'] + " ",
-                            box=True,
-                            win_size=(maxy - 6, maxx - 6),
-                            win_location=(3, 3))()
-            obj[msel]['value'] = newval
+            new = not value
 
-        # reset to previous state
-        curses.curs_set(0)
-        screen.clear()
-        screen.border()
-        screen.addstr(0, 2, 'ENTER/SPACE: Enter/edit | ESC/BACKSP: Exit | R: '
-                            'Run commands | Q: Quit ', curses.color_pair(1))
-        screen.refresh()
+        if new != value:
+            elem.value = new
+            changed.append(elem.eid)
 
-    elif 'textdisplay' in obj[msel]:
+    PROFILER.count('bulk changes', len(changed))
 
-        # open scrollable window
-        draw_popup(screen, obj[msel]['value'])
+    return changed
 
 
 def main():
@@ -976,40 +5387,283 @@ def main():
 
     :return: Exit value
     """
+    global WATCHER, INPUT_TIMEOUT, LOW_BANDWIDTH, SESSION, STARTUP
+
     # fix the curses ESCAPE key delay
     os.environ['ESCDELAY'] = '0'
 
-    if len(sys.argv) < 2:
-        print("Please provide a file!")
-        quit(1)
+    parser = argparse.ArgumentParser(
+        description='YAML InterFace - menu driven editor of YAML values.')
+    parser.add_argument('file', help='YAML definition file')
+    parser.add_argument('target', nargs='?',
+                        help='ID or path (e.g. bus_opts/pci_access_mode) of '
+                             'menu or page to open right away')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='record keystroke latencies and write '
+                             'histograms to REPORT on exit')
+    parser.add_argument('--cprofile', metavar='DUMP',
+                        help='together with --profile, write cProfile '
+                             'statistics to DUMP')
+    parser.add_argument('--watch', action='store_true',
+                        help='reload definition and service functions when '
+                             'they change on disk')
+    parser.add_argument('--low-bandwidth', action='store_true',
+                        help='draw no borders, colors or non-ASCII '
+                             'markers, for slow serial consoles')
+    parser.add_argument('--record', metavar='FILE',
+                        help='write keystrokes and terminal size to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='feed keystrokes recorded in FILE to the UI '
+                             'in a pseudo terminal, print latency of '
+                             'each of them and exit')
+    parser.add_argument('--stream', action='store_true',
+                        help='build the model from parser events, uses less '
+                             'memory with very large definitions')
+    parser.add_argument('--check', action='store_true',
+                        help='check constraints of all pages, print '
+                             'problems and exit')
+    parser.add_argument('--validate-all', action='store_true',
+                        help='run on_save functions and constraints of all '
+                             'pages, print report and exit')
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help='number of workers for --validate-all and '
+                             '--materialize')
+    parser.add_argument('--load-data', action='store_true',
+                        help='start with values saved before')
+    parser.add_argument('--convert-data', choices=sorted(STORES),
+                        help='convert saved values to single file, '
+                             'directory with file per page or SQLite '
+                             'database and exit')
+    parser.add_argument('--export-data', metavar='FILE',
+                        help='write all saved values into FILE in '
+                             '_data.yaml format and exit')
+    parser.add_argument('--host-profiles', metavar='FILE',
+                        help='base, group and host values layered over '
+                             'defaults')
+    parser.add_argument('--host', metavar='HOST',
+                        help='edit on top of values of HOST from '
+                             '--host-profiles')
+    parser.add_argument('--materialize', metavar='DIR',
+                        help='validate and write <host>_data.yaml of every '
+                             'host from --host-profiles into DIR and exit')
+    parser.add_argument('--bench-load', action='store_true',
+                        help='print load time and peak memory of both '
+                             'loaders and exit')
+    args = parser.parse_intermixed_args()
+
+    if (args.host is not None or args.materialize is not None) and \
+            args.host_profiles is None:
+        parser.error('--host and --materialize need --host-profiles')
+
+    if args.profile is not None:
+        PROFILER.enable(args.cprofile is not None)
+        atexit.register(PROFILER.write, args.profile, args.cprofile)
 
     # start with first item selected
     msel = 0
 
-    fn = sys.argv[1]
+    fn = args.file
 
-    # open file & set up screen
-    yamlobj = open_yaml(fn)
+    if args.bench_load:
+        bench_load(fn)
+        quit(0)
 
-    # try to load service functions
-    load_service_functions(fn, globals())
+    if args.convert_data is not None:
+        print("Converted %d pages" % convert_data(fn, args.convert_data))
+        quit(0)
+
+    if args.export_data is not None:
+        print("Exported %d pages" % open_store(fn).export(args.export_data))
+        quit(0)
+
+    # definition is compiled and service functions are imported in
+    # background threads, UI meanwhile shows root menu read by a quick scan
+    headless = args.check or args.validate_all or \
+        args.materialize is not None
+    preview = None
+    stdscr = None
+
+    startup = Startup(fn, 'stream' if args.stream else 'dict', args.watch,
+                      not args.check)
+
+    # scan runs while the definition is compiled
+    if not headless and args.target is None and args.replay is None:
+        preview = scan_root(fn)
+
+    def fail(message):
+        # terminal has to be restored before anything is printed
+        if stdscr is not None:
+            clean_curses()
+        print(message)
+        quit(1)
+
+    def finish_startup():
+        global HOST
+
+        try:
+            tree = startup.wait()
+        except SchemaError as err:
+            fail("Invalid definition in %s: %s" % (fn, err))
+        except Exception:
+            if stdscr is not None:
+                clean_curses()
+            raise
+
+        # without UI nothing would show sourced values once they're loaded
+        if headless:
+            wait_sources(tree)
+
+        # host profile goes under saved values and edits
+        if args.host is not None:
+            try:
+                use_host(tree, args.host_profiles, args.host)
+            except (SchemaError, yaml.YAMLError, OSError) as err:
+                fail("Can't use %s: %s" % (args.host_profiles, err))
+
+            HOST = (args.host_profiles, args.host)
+
+        # values saved before, shards are read concurrently
+        if args.load_data:
+            t0 = PROFILER.start()
+            apply_saved(tree, open_store(fn).load_all(), blob_dir(fn))
+            PROFILER.record('load_saved', t0)
+
+        PROFILER.milestone('startup fully loaded')
+
+        return tree
+
+    tree = finish_startup() if preview is None else None
+
+    # values of all hosts, workers get the tree compiled above
+    if args.materialize is not None:
+        try:
+            failed = materialize_all(fn, 'stream' if args.stream else 'dict',
+                                     args.host_profiles, tree,
+                                     args.materialize, args.jobs)
+        except (SchemaError, yaml.YAMLError, OSError) as err:
+            print("Can't use %s: %s" % (args.host_profiles, err))
+            quit(1)
+
+        print("\n%d hosts failed" % failed)
+        quit(1 if failed > 0 else 0)
+
+    # headless check of the whole definition
+    if args.check:
+        problems = check_tree(tree)
+
+        for pid, page_problems in problems.items():
+            for eid, problem in page_problems:
+                print("%s/%s: %s" % (pid, eid, problem))
+
+        quit(1 if len(problems) > 0 else 0)
+
+    # headless validation of the whole definition
+    if args.validate_all:
+        def progress(done, total, pid):
+            print("[%d/%d] %s" % (done, total, pid))
+
+        results = validate_tree(tree, args.jobs, progress)
+        failed = [pid for pid in results
+                  if validation_failed(results[pid])]
+
+        for pid, result in results.items():
+            print("\n%s (%s): %s" % (pid, tree.nodes[pid].title,
+                                     'FAILED' if pid in failed else 'ok'))
+            print(format_validation(tree, pid, result))
+
+        print("\n%d pages failed" % len(failed))
+        quit(1 if len(failed) > 0 else 0)
+
+    # find menu or page given on command line
+    path = [tree.root.nid if preview is None else preview.nid]
+
+    if args.target is not None:
+        try:
+            path = resolve_target(tree, args.target)
+        except SchemaError as err:
+            print("Can't open %s: %s" % (args.target, err))
+            quit(1)
+
+        # hidden menu hides everything in it
+        for parent, nid in zip(path, path[1:]):
+            if nid not in get_menulist(tree.nodes[parent])[0]:
+                print("Can't open %s: it's hidden by depends_on" %
+                      args.target)
+                quit(1)
+
+    # replayed session runs in a pseudo terminal, this process only waits
+    # for its report and doesn't write reports of its own
+    if args.replay is not None:
+        SESSION = Replayer(args.replay)
+        status = SESSION.run()
+
+        if status is not False:
+            sys.stdout.flush()
+            os._exit(status)
+    elif args.record is not None:
+        SESSION = Recorder(args.record)
 
     # initialize curses
+    LOW_BANDWIDTH = args.low_bandwidth
     stdscr = init_curses()
 
-    # top menu defaults
-    mhist = []
-    mid = yamlobj['menu']
-    mtitle = yamlobj['title']
-    mhist.append(mid)
+    # watch for changes, UI checks for them when getch() times out
+    if args.watch:
+        WATCHER = FileWatcher([fn, re.sub('.yaml$', '.py', fn)])
+        WATCHER.start()
+        INPUT_TIMEOUT = 250
+        stdscr.timeout(INPUT_TIMEOUT)
+
+    # root menu from the scan can be browsed until the definition is loaded
+    if tree is None:
+        STARTUP = startup
+        idle_timeout = INPUT_TIMEOUT
+        INPUT_TIMEOUT = STARTUP_POLL
+        stdscr.timeout(INPUT_TIMEOUT)
+
+        while not startup.done():
+            try:
+                msel = max(draw_menu(stdscr, None, preview, msel), 0)
+            except Loaded as req:
+                msel = req.msel
+                break
+
+        if not startup.done():
+            draw_progress(stdscr, 'Loading %s ...' % fn)
+
+        tree = finish_startup()
+        STARTUP = None
+        INPUT_TIMEOUT = idle_timeout
+        stdscr.timeout(INPUT_TIMEOUT)
+        draw_background(stdscr)
 
-    # get content for the first menu
-    menu_ids, menu_titles = get_menulist(yamlobj, True)
+    # top menu defaults, menus above the target are only put into history
+    mhist = path[:-1] if len(path) > 1 else path[:]
+    menu = tree.nodes[mhist[-1]]
+    mid = menu.nid
+
+    # target is opened as if it was selected from its menu
+    direct = None
+
+    if len(path) > 1:
+        direct = msel = get_menulist(menu)[0].index(path[-1])
 
     # main loop that draws menu and allows to traverse & open menu items
     while True:
 
-        msel = draw_menu(stdscr, yamlobj, menu_titles, mtitle, msel)
+        try:
+            if direct is None:
+                msel = draw_menu(stdscr, tree, menu, msel)
+            direct = None
+        except Reload as req:
+            tree = reload_definition(stdscr, fn, tree)
+            mhist, menu = restore_menu(tree, mhist)
+            msel = req.msel
+            continue
+        except ValidateAll as req:
+            draw_validation(stdscr, tree, fn)
+            msel = req.msel
+            continue
 
         # leaving menu and going back to top
         if msel == -1:
@@ -1020,31 +5674,59 @@ def main():
                 msel = 0
                 continue
         else:
-            mid = menu_ids[msel]
+            mid = get_menulist(menu)[0][msel]
 
-        eltype = get_nodetype(yamlobj, mid)
+        node = tree.nodes[mid]
 
         # we entered menu, append it to history
-        if eltype == 'menu':
+        if node.kind == MENU:
             mhist.append(mid)
 
         # determine what we try to open and act accordingly
-        if eltype == 'page':
+        if node.kind == PAGE:
             psel = 0
+            idle_timeout = INPUT_TIMEOUT
 
             # don't leave page unless ESC is pressed
             while psel != -1:
-                psel = draw_page(stdscr, yamlobj, fn,
-                                 get_objectcontent(yamlobj, mid), mid,
-                                 get_title(yamlobj, mid),
-                                 psel)
 
-        elif eltype == 'menu':
+                # pick up changes, leave the page if it's gone
+                if WATCHER is not None and WATCHER.pending():
+                    tree = reload_definition(stdscr, fn, tree)
+                    mhist, menu = restore_menu(tree, mhist)
+                    node = tree.nodes.get(mid)
+
+                    if node is None or node.kind != PAGE:
+                        break
+
+                # page itself might get hidden by its own elements
+                if not node.visible:
+                    break
+
+                # poll while source commands run, keep cursor on the same
+                # element when their outputs change the page
+                shown = shown_content(node)
+                loading = apply_sources(tree, node)
+                INPUT_TIMEOUT = SOURCE_POLL if loading else idle_timeout
+                stdscr.timeout(INPUT_TIMEOUT)
+
+                content = shown_content(node)
+
+                if content is not shown and psel < len(shown) and \
+                        shown[psel] in content:
+                    psel = content.index(shown[psel])
+
+                psel = max(min(psel, len(content) - 1), 0)
+                psel = draw_page(stdscr, tree, fn, content, mid,
+                                 node.title, psel)
+
+            INPUT_TIMEOUT = idle_timeout
+            stdscr.timeout(INPUT_TIMEOUT)
+
+        elif node.kind == MENU:
 
-            # entering new menu, get title and content
-            mtitle = get_title(yamlobj, mid)
-            menu_ids, menu_titles = get_menulist(
-                get_objectcontent(yamlobj, mid))
+            # entering new menu
+            menu = node
             msel = 0
 
     # quit